@@ -0,0 +1,175 @@
+# خادم Bot API وهمي لقياس أداء البوت دون الاتصال بتيليجرام.
+# يقبل طرق Bot API الشائعة ويعيد ردودًا صالحة، مع تأخير قابل للضبط وحقن أخطاء 429 (RetryAfter).
+#
+# التشغيل المستقل:  python bench/fake_bot_api.py --port 8081 --latency-ms 40 --retry-after-rate 0.01
+# ثم شغّل البوت بـ BOT_API_URL=http://127.0.0.1:8081
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 424242, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+_CHAT_ID_MULTIPART = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 1,
+                 upload_bps: float = 0.0, member_status: str = "member", seed: int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.upload_bps = upload_bps  # 0 = بلا حد
+        self.member_status = member_status
+        self.rnd = random.Random(seed)
+        self.calls: dict[str, int] = {}
+        self.injected_429 = 0
+        self.bytes_received = 0
+        self._message_id = 0
+        self._file_id = 0
+        self._server: asyncio.Server | None = None
+
+    # ---------- HTTP ----------
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                _, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                self.bytes_received += len(body)
+                method = path.rstrip("/").rsplit("/", 1)[-1]
+                status, payload = await self.call(method, self._params(headers, body), len(body))
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(headers: dict, body: bytes) -> dict:
+        ctype = headers.get("content-type", "")
+        if ctype.startswith("multipart/"):
+            m = _CHAT_ID_MULTIPART.search(body[:4096])
+            return {"chat_id": m.group(1).decode()} if m else {}
+        if ctype.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+
+    # ---------- Bot API ----------
+    async def call(self, method: str, params: dict, size: int) -> tuple[int, dict]:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getUpdates":
+            await asyncio.sleep(float(params.get("timeout", 0) or 0))
+            return 200, {"ok": True, "result": []}
+
+        delay = self.latency + self.rnd.uniform(0, self.jitter)
+        if method == "sendDocument" and self.upload_bps:
+            delay += size / self.upload_bps
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.retry_after_rate and method not in ("getMe", "getChatMember") \
+                and self.rnd.random() < self.retry_after_rate:
+            self.injected_429 += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+
+        result = self.result(method, params)
+        return 200, {"ok": True, "result": result}
+
+    def _message(self, params: dict, **extra) -> dict:
+        self._message_id += 1
+        chat_id = int(params.get("chat_id") or 1)
+        msg = {
+            "message_id": int(params.get("message_id") or self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            msg["text"] = params["text"]
+        msg.update(extra)
+        return msg
+
+    def result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            return self._message(params)
+        if method == "sendDocument":
+            document = params.get("document")
+            if not document or str(document).startswith("attach://"):
+                self._file_id += 1
+                document = f"FAKEFILE{self._file_id}"
+            return self._message(params, document={
+                "file_id": document, "file_unique_id": document, "file_name": "book.pdf",
+            })
+        if method == "getChatMember":
+            return {"status": self.member_status,
+                    "user": {"id": int(params.get("user_id") or 0), "is_bot": False, "first_name": "u"}}
+        # answerCallbackQuery, sendChatAction, deleteMessage, setWebhook, ...
+        return True
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "injected_429": self.injected_429,
+                "mb_received": round(self.bytes_received / 1048576, 1)}
+
+
+async def _serve(args):
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.retry_after_rate, args.retry_after,
+                     args.upload_mbps * 1048576)
+    port = await api.start(args.host, args.port)
+    print(f"fake Bot API on http://{args.host}:{port}  (BOT_API_URL=http://{args.host}:{port})")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(api.stats())
+    finally:
+        await api.stop()
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--latency-ms", type=float, default=30)
+    p.add_argument("--jitter-ms", type=float, default=20)
+    p.add_argument("--retry-after-rate", type=float, default=0.0)
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--upload-mbps", type=float, default=0.0)
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,83 @@
+# قياس أثر كاش لوحات المفاتيح على on_callback: الزمن وذروة التخصيص لكل استدعاء.
+# التشغيل:  python bench/keyboards.py [عدد_التكرارات]
+import asyncio
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+CONTEXT = SimpleNamespace(bot=SimpleNamespace(edit_message_text=_noop))
+
+
+def fake_callback(data: str, uid: int = 1):
+    message = SimpleNamespace(chat=SimpleNamespace(id=uid), message_id=1)
+    query = SimpleNamespace(data=data, message=message, answer=_noop, edit_message_text=_noop)
+    return SimpleNamespace(
+        callback_query=query,
+        effective_user=SimpleNamespace(id=uid),
+        effective_chat=message.chat,
+        effective_message=message,
+    )
+
+
+def screens() -> list[str]:
+    data = ["back|main"]
+    for section, items in bot.CATALOG.items():
+        data.append(f"cat|{section}")
+        data += [f"series|{itm['id']}" for itm in items if "children" in itm]
+    return data
+
+
+async def run(updates, rounds: int, cached: bool) -> tuple[float, float]:
+    context = CONTEXT
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for upd in updates:
+            if not cached:
+                bot.invalidate_kb()
+            await bot.on_callback(upd, context)
+    elapsed = time.perf_counter() - start
+
+    # ذروة الذاكرة المخصّصة لكل استدعاء، في جولة منفصلة لأن tracemalloc يبطئ التنفيذ
+    peak_total = 0
+    tracemalloc.start()
+    for upd in updates:
+        if not cached:
+            bot.invalidate_kb()
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        await bot.on_callback(upd, context)
+        peak_total += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    calls = rounds * len(updates)
+    return elapsed / calls * 1e6, peak_total / len(updates)
+
+
+async def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    updates = [fake_callback(d) for d in screens()]
+    for upd in updates:  # تسخين الكاش
+        await bot.on_callback(upd, CONTEXT)
+
+    cold_us, cold_bytes = await run(updates, rounds, cached=False)
+    warm_us, warm_bytes = await run(updates, rounds, cached=True)
+    print(f"screens={len(updates)} rounds={rounds}")
+    print(f"{'mode':<10}{'µs/callback':>14}{'alloc bytes/callback':>22}")
+    print(f"{'uncached':<10}{cold_us:>14.1f}{cold_bytes:>22.0f}")
+    print(f"{'cached':<10}{warm_us:>14.1f}{warm_bytes:>22.0f}")
+    print(f"speedup x{cold_us / warm_us:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
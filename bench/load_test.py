@@ -0,0 +1,181 @@
+# اختبار حمل دون اتصال: يشغّل البوت الحقيقي (نفس المعالجات والجدولة والكاش) مقابل خادم Bot API وهمي
+# ويضخّ تحديثات مصطنعة لعدد من المستخدمين، ثم يطبع معدل التحديثات وزمن الاستجابة p50/p99
+# وعدد أخطاء 429 المحقونة واستدعاءات الـ API وذروة الذاكرة.
+#
+# التشغيل:  python bench/load_test.py --users 500 --latency-ms 40 --retry-after-rate 0.01
+# حدود الإرسال الحقيقية مفعّلة افتراضيًا؛ --no-rate-limit يرفعها لقياس سقف البوت نفسه.
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+BOT_ID = 424242
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Driver:
+    def __init__(self, bot, app, rnd: random.Random):
+        self.bot = bot
+        self.app = app
+        self.rnd = rnd
+        self.update_id = 0
+        self.message_id = 0
+        self.enqueued: dict[int, float] = {}
+        self.latencies: list[float] = []
+        cat = bot.CATALOG
+        self.sections = list(cat)
+        self.series = list(cat.series)
+        self.files = [i for i, p in cat.assets.items() if p is not None] or list(cat.files)
+        self.words = [w for label in cat.labels.values() for w in label.split() if len(w) > 3] or ["book"]
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "language_code": "ar"}
+
+    def _message(self, uid: int, text: str, from_bot: bool = False) -> dict:
+        self.message_id += 1
+        msg = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"} if from_bot else self._user(uid),
+            "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return msg
+
+    def text(self, uid: int, text: str) -> dict:
+        return {"message": self._message(uid, text)}
+
+    def tap(self, uid: int, data: str) -> dict:
+        return {"callback_query": {
+            "id": f"{uid}-{self.update_id}",
+            "from": self._user(uid),
+            "chat_instance": str(uid),
+            "message": self._message(uid, "menu", from_bot=True),
+            "data": data,
+        }}
+
+    def session(self, uid: int, files: int) -> list[dict]:
+        # جلسة مستخدم نموذجية: ترحيب، دخول، تصفح قسم وصفحاته وسلسلة، تحميل، بحث، تغيير لغة
+        r = self.rnd
+        section = r.choice(self.sections)
+        steps = [self.text(uid, "/start"), self.tap(uid, "go|start"), self.tap(uid, f"cat|{section}")]
+        steps += [self.tap(uid, f"cat|{section}|{p}") for p in range(1, r.randint(1, 3))]
+        if self.series:
+            steps.append(self.tap(uid, f"series|{r.choice(self.series)}"))
+        steps += [self.tap(uid, f"file|{r.choice(self.files)}") for _ in range(files)]
+        steps.append(self.text(uid, r.choice(self.words)))
+        steps += [self.tap(uid, "back|main"), self.tap(uid, f"lang|{r.choice(('ar', 'en'))}")]
+        return steps
+
+    async def feed(self, steps: list[dict], think: float):
+        from telegram import Update
+        for step in steps:
+            self.update_id += 1
+            update = Update.de_json({"update_id": self.update_id, **step}, self.app.bot)
+            self.enqueued[self.update_id] = time.perf_counter()
+            await self.app.update_queue.put(update)
+            if think:
+                await asyncio.sleep(self.rnd.uniform(0, 2 * think))
+
+    async def done(self, update, context):
+        started = self.enqueued.pop(update.update_id, None)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.latency_ms, args.jitter_ms, args.retry_after_rate, args.retry_after,
+                     args.upload_mbps * 1048576, seed=args.seed)
+    port = await api.start()
+
+    tmp = tempfile.mkdtemp(prefix="bot-load-")
+    os.environ.update({
+        "BOT_API_URL": f"http://127.0.0.1:{port}",
+        "FILE_ID_DB": os.path.join(tmp, "file_ids.sqlite3"),
+        "STATE_DB": os.path.join(tmp, "users.sqlite3"),
+        "META_DB": os.path.join(tmp, "meta.sqlite3"),
+        "UPDATE_STATS_SECONDS": "0",
+        "CATALOG_WATCH_SECONDS": "0",
+    })
+    if args.channel:
+        os.environ["REQUIRED_CHANNEL"] = args.channel
+    if args.no_rate_limit:
+        os.environ.update({"RATE_GLOBAL": "1000000", "RATE_PRIVATE_CHAT": "1000000",
+                           "RATE_CHAT_BURST": "1000000"})
+    import bot
+    from telegram.ext import TypeHandler
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    from telegram import Update
+
+    app = bot.build_app(f"{BOT_ID}:LOADTEST")
+    driver = Driver(bot, app, random.Random(args.seed))
+    # المجموعة 1 تعمل بعد انتهاء معالج المجموعة 0 لنفس التحديث
+    app.add_handler(TypeHandler(Update, driver.done), group=1)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    sessions = [driver.session(uid, args.files) for uid in range(1000, 1000 + args.users)]
+    total = sum(map(len, sessions))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(driver.feed(steps, args.think_ms / 1000) for steps in sessions))
+    await app.update_queue.join()
+    elapsed = time.perf_counter() - t0
+
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await api.stop()
+
+    return {
+        "users": args.users,
+        "updates": total,
+        "seconds": round(elapsed, 2),
+        "updates_per_s": round(total / elapsed, 1),
+        "p50_ms": round(percentile(driver.latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(driver.latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(driver.latencies, default=0) * 1000, 1),
+        "unfinished": len(driver.enqueued),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "outbound": bot.OUTBOUND.stats(),
+        "fake_api": api.stats(),
+    }
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser()
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--files", type=int, default=1, help="تحميلات لكل مستخدم")
+    p.add_argument("--think-ms", type=float, default=0, help="متوسط المهلة بين نقرات المستخدم")
+    p.add_argument("--latency-ms", type=float, default=30)
+    p.add_argument("--jitter-ms", type=float, default=20)
+    p.add_argument("--retry-after-rate", type=float, default=0.0)
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--upload-mbps", type=float, default=0.0)
+    p.add_argument("--channel", default="", help="قناة الاشتراك الإجباري (getChatMember يعيد member)")
+    p.add_argument("--no-rate-limit", action="store_true")
+    p.add_argument("--seed", type=int, default=1)
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    for key, value in asyncio.run(run(parse_args())).items():
+        print(f"{key:>14}: {value}")
@@ -0,0 +1,42 @@
+# زمن البحث في فهرس الثلاثيات مع عدد كبير من العناوين المولّدة.
+# التشغيل:  python bench/search.py [عدد_العناوين]
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import bot  # noqa: E402
+
+WORDS = (
+    "برمجة تصميم الأمن الشبكات لينكس بايثون جافاسكربت قواعد البيانات الذكاء الاصطناعي "
+    "التسويق السيو الصيانة الجوال الإنجليزية محادثة مقدمة أساسيات دليل المبتدئين المتقدم "
+    "python linux network hacking design marketing excel word guide beginners advanced "
+    "security data science machine learning deep web mobile cloud"
+).split()
+
+
+def make_docs(n: int, seed: int = 1) -> list[tuple[str, str]]:
+    rnd = random.Random(seed)
+    return [(f"id{i}", " ".join(rnd.choices(WORDS, k=rnd.randint(2, 6))) + f" {i}") for i in range(n)]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    started = time.perf_counter()
+    index = bot.SearchIndex(make_docs(n))
+    print(f"titles={n} build={time.perf_counter() - started:.2f}s grams={len(index.postings)}")
+
+    queries = ["لينكس", "الأمن الشبكات", "الاصطناعي", "python", "deep learning", "دليل المبتدئين",
+               "السيو", "excel guide", "اساسيات", "لينوكس", "pyhton", "zzz"]
+    for q in queries:
+        rounds = 50
+        started = time.perf_counter()
+        for _ in range(rounds):
+            hits = index.search(q)
+        ms = (time.perf_counter() - started) / rounds * 1000
+        print(f"{q!r:<20} {ms:7.3f} ms  hits={len(hits)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,60 @@
 # bot.py
 import os
+import re
 import json
+import asyncio
+import base64
+import functools
+import hashlib
+import heapq
+import hmac
 import logging
+import marshal
+import mmap
+import signal
+import sqlite3
+import sys
+import time
+import unicodedata
+import zipfile
+import zlib
+from itertools import chain, islice
 from pathlib import Path
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
-
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
+from threading import Lock
+
+import httpx
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedDocument,
     InputFile,
+    InputTextMessageContent,
     KeyboardButton,
     ReplyKeyboardMarkup,
 )
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
+    InlineQueryHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
-from telegram.error import BadRequest
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter, TelegramError
 
 # ===================== إعدادات عامة =====================
 TOKEN = os.getenv("TELEGRAM_TOKEN") or os.getenv("TOKEN") or ""
@@ -31,6 +63,7 @@ OWNER_USERNAME = (os.getenv("OWNER_USERNAME") or os.getenv("ADMIN_USERNAME") or
 
 CATALOG_PATH = "assets/catalog.json"
 BASE_DIR = Path(__file__).parent.resolve()
+FILE_ID_DB = os.getenv("FILE_ID_DB") or str(BASE_DIR / "assets" / "file_ids.sqlite3")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,10 +71,235 @@ logging.basicConfig(
 )
 log = logging.getLogger("courses-bot")
 
-# لغة المستخدم وحالة إرسال لوحة المفاتيح
-USER_LANG: dict[int, str] = {}          # user_id -> 'ar' | 'en'
-KB_SENT: set[int] = set()               # users الذين أرسِلَت لهم اللوحة السفلية
-MENU_MSG: dict[int, tuple[int, int]] = {}  # user_id -> (chat_id, message_id) لرسالة القائمة القابلة للتعديل
+# ===================== المقاييس (Prometheus) =====================
+# عدّادات ومدرّجات بسيطة تُحدَّث من حلقة asyncio بلا أقفال، وتُعرض على /metrics.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in labels) + "}"
+
+class Metrics:
+    def __init__(self):
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+        self.gauges: dict[str, object] = {}  # name -> دالة تعيد رقمًا أو {labels: رقم}
+        self.help: dict[str, str] = {}
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float):
+        series = self.histograms.setdefault(name, {})
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = Histogram()
+        hist.observe(value)
+
+    def gauge(self, name: str, fn, help_text: str = ""):
+        self.gauges[name] = fn
+        if help_text:
+            self.help[name] = help_text
+
+    def render(self) -> str:
+        out = []
+        for name, series in self.counters.items():
+            out.append(f"# TYPE {name} counter")
+            out += [f"{name}{_labels(lb)} {v}" for lb, v in series.items()]
+        for name, series in self.histograms.items():
+            out.append(f"# TYPE {name} histogram")
+            for lb, h in series.items():
+                acc = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    acc += n
+                    out.append(f"{name}_bucket{_labels(lb + (('le', bound),))} {acc}")
+                out.append(f"{name}_bucket{_labels(lb + (('le', '+Inf'),))} {h.count}")
+                out.append(f"{name}_sum{_labels(lb)} {h.sum}")
+                out.append(f"{name}_count{_labels(lb)} {h.count}")
+        for name, fn in self.gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if name in self.help:
+                out.append(f"# HELP {name} {self.help[name]}")
+            out.append(f"# TYPE {name} gauge")
+            if isinstance(value, dict):
+                out += [f"{name}{_labels(lb)} {v}" for lb, v in value.items()]
+            else:
+                out.append(f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+
+def timed(name: str, label=None):
+    # يقيس زمن المعالج في مدرّج handler_seconds{handler=name[, kind=...]}
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(update, context):
+            started = time.perf_counter()
+            try:
+                return await fn(update, context)
+            finally:
+                labels = (("handler", name),)
+                if label:
+                    labels += (("kind", label(update)),)
+                METRICS.observe("handler_seconds", labels, time.perf_counter() - started)
+        return inner
+    return wrap
+
+# ===================== حالة المستخدمين =====================
+# لغة المستخدم، هل أُرسلت له اللوحة السفلية، ورسالة القائمة القابلة للتعديل.
+# تُحفظ في LRU محدود الحجم داخل الذاكرة، وتُكتب إلى SQLite على دفعات (write-behind)
+# حتى لا تنتظر القراءات المتكررة القرص ولا تضيع الحالة عند إعادة التشغيل. المستخدم غير الموجود
+# في الذاكرة يُحمَّل في خيط قبل معالجة تحديثه (preload)، فلا تنتظر الحلقة SQLite ولا قفل الكتابة.
+STATE_DB = os.getenv("STATE_DB", str(BASE_DIR / "assets" / "users.sqlite3"))  # "" = ذاكرة فقط
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+STATE_FLUSH_SECONDS = float(os.getenv("STATE_FLUSH_SECONDS", "5"))
+STATE_FLUSH_BATCH = 1000
+
+class UserState:
+    __slots__ = ("lang", "kb_sent", "menu", "rendered")
+
+    def __init__(self, lang: str = "ar", kb_sent: bool = False, menu: tuple[int, int] | None = None):
+        self.lang = lang
+        self.kb_sent = kb_sent
+        self.menu = menu  # (chat_id, message_id)
+        self.rendered = None  # (chat_id, message_id, hash) آخر شاشة أُرسلت؛ في الذاكرة فقط
+
+    def row(self, uid: int) -> tuple:
+        chat_id, msg_id = self.menu or (None, None)
+        return (uid, self.lang, int(self.kb_sent), chat_id, msg_id)
+
+class SQLiteStateBackend:
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " uid INTEGER PRIMARY KEY, lang TEXT, kb_sent INTEGER,"
+            " menu_chat INTEGER, menu_msg INTEGER)"
+        )
+        self._db.commit()
+
+    def load(self, uid: int) -> UserState | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT lang, kb_sent, menu_chat, menu_msg FROM users WHERE uid = ?", (uid,)
+            ).fetchone()
+        if not row:
+            return None
+        lang, kb_sent, chat_id, msg_id = row
+        return UserState(lang, bool(kb_sent), (chat_id, msg_id) if msg_id is not None else None)
+
+    def save_many(self, rows: list[tuple]):
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)", rows)
+
+class UserStore:
+    def __init__(self, backend=None, capacity: int = USER_CACHE_SIZE):
+        self.backend = backend
+        self.capacity = capacity
+        self._lru: OrderedDict[int, UserState] = OrderedDict()
+        self._dirty: dict[int, tuple] = {}
+        self._flushing: dict[int, tuple] = {}  # الدفعة التي تُكتب الآن: تبقى مقروءة حتى تُحفظ
+        self._flush_lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def _unsaved(self, uid: int) -> UserState | None:
+        row = self._dirty.get(uid) or self._flushing.get(uid)
+        if row is None:
+            return None
+        return UserState(row[1], bool(row[2]), (row[3], row[4]) if row[4] is not None else None)
+
+    def _remember(self, uid: int, st: UserState) -> UserState:
+        self._lru[uid] = st
+        if len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)  # التعديلات غير المحفوظة باقية في _dirty
+        return st
+
+    def get(self, uid: int) -> UserState:
+        st = self._lru.get(uid)
+        if st is not None:
+            self._lru.move_to_end(uid)
+            return st
+        st = self._unsaved(uid)
+        if st is None:
+            # نادر: التحديثات تمر بـ preload أولًا
+            st = (self.backend.load(uid) if self.backend else None) or UserState()
+        return self._remember(uid, st)
+
+    async def preload(self, uid: int):
+        if not self.backend or uid in self._lru:
+            return
+        st = self._unsaved(uid)
+        if st is None:
+            st = await asyncio.to_thread(self.backend.load, uid)
+            # قد يكون المستخدم قُرئ أو عُدّل أثناء الانتظار: النسخة التي في الذاكرة أحدث
+            if uid in self._lru:
+                return
+            st = self._unsaved(uid) or st or UserState()
+        self._remember(uid, st)
+
+    def update(self, uid: int, **fields):
+        st = self.get(uid)
+        for k, v in fields.items():
+            setattr(st, k, v)
+        if self.backend:
+            self._dirty[uid] = st.row(uid)
+            if len(self._dirty) >= STATE_FLUSH_BATCH:
+                self._wake.set()
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            self._flushing, self._dirty = self._dirty, {}
+            try:
+                await asyncio.to_thread(self.backend.save_many, list(self._flushing.values()))
+            except Exception:
+                # نعيدها للمحاولة التالية دون الكتابة فوق تعديلات أحدث
+                for uid, row in self._flushing.items():
+                    self._dirty.setdefault(uid, row)
+                raise
+            finally:
+                self._flushing = {}
+
+    async def flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), STATE_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                log.warning("User state flush failed: %s", e)
+
+USERS = UserStore(SQLiteStateBackend(STATE_DB) if STATE_DB else None)
 
 # نصوص الواجهات
 L = {
@@ -68,6 +326,14 @@ L = {
         "help_text_contact": "للتواصل مع الإدارة:",
         "greet_text": "أهلًا وسهلًا! استمتع بالتصفح 🤍",
         "info_fmt": "اسم: {name}\nيوزر: @{user}\nمعرّف: {uid}\nاللغة: {lang}",
+        "search_results": "🔎 نتائج البحث عن: {q}",
+        "search_none": "🔎 لا توجد نتائج لـ: {q}",
+        "search_open": "📥 تحميل من البوت",
+        "preparing": "⏳ جارٍ تحضير الملف… سيصلك خلال لحظات.",
+        "bundle": "📦 تحميل السلسلة كاملة (ZIP)",
+        "bundle_too_big": "⚠️ السلسلة كاملة أكبر من حد الإرسال في تيليجرام، حمّل الأجزاء واحدًا واحدًا.",
+        "too_big": "⚠️ حجم هذا الملف ({size}) أكبر من حد الإرسال في تيليجرام، لذا لا يمكن إرساله عبر البوت حاليًا.",
+        "pages_short": "ص",
         "sections": {
             "prog": "💻 البرمجة",
             "design": "🎨 التصميم",
@@ -101,6 +367,14 @@ L = {
         "help_text_contact": "Contact the admin:",
         "greet_text": "Hi there! Enjoy browsing 🤍",
         "info_fmt": "Name: {name}\nUser: @{user}\nUser ID: {uid}\nLang: {lang}",
+        "search_results": "🔎 Results for: {q}",
+        "search_none": "🔎 No results for: {q}",
+        "search_open": "📥 Get it from the bot",
+        "preparing": "⏳ Preparing your file… it will arrive shortly.",
+        "bundle": "📦 Download the whole series (ZIP)",
+        "bundle_too_big": "⚠️ The whole series is larger than Telegram's upload limit; please download the parts one by one.",
+        "too_big": "⚠️ This file ({size}) is larger than Telegram's upload limit, so the bot can't send it for now.",
+        "pages_short": "p",
         "sections": {
             "prog": "💻 Programming",
             "design": "🎨 Design",
@@ -115,47 +389,646 @@ L = {
 
 ALLOWED_EXTS = {".pdf", ".zip", ".rar"}
 
+# ===================== فهرس الأصول + حل ذكي للمسارات =====================
+ASSETS_DIR = BASE_DIR / "assets"
+ASSET_INDEX_POLL = float(os.getenv("ASSET_INDEX_POLL", "30"))  # ثوانٍ بين فحوص التغيير، 0 = معطّل
+
+def _norm(s: str) -> str:
+    return "".join(ch.lower() for ch in s if ch.isalnum())
+
+def _rel(p: Path) -> str:
+    return p.relative_to(BASE_DIR).as_posix()
+
+def _scan_dir(d: Path) -> tuple[int, list[Path], list[Path]]:
+    # (mtime_ns, الملفات المسموحة, المجلدات الفرعية) لمجلد واحد دون نزول
+    files, subdirs = [], []
+    mtime_ns = d.stat().st_mtime_ns
+    for f in sorted(d.iterdir()):
+        if f.is_dir():
+            subdirs.append(f)
+        elif f.is_file() and f.suffix.lower() in ALLOWED_EXTS:
+            files.append(f)
+    return mtime_ns, files, subdirs
+
+# فهرس لملفات assets/ يُبنى مرة واحدة، وكل البحث بعدها من الذاكرة.
+# لا يُعدَّل بعد بنائه؛ التحديث يُنتج نسخة جديدة تُبدَّل دفعة واحدة.
+class AssetIndex:
+    def __init__(self, root: Path, dirs: dict[Path, tuple[int, list[Path], list[Path]]]):
+        self.root = root
+        self._dirs = dirs
+        self.by_path: dict[str, Path] = {}
+        self.by_dir_stem: dict[tuple[str, str], Path] = {}
+        self.by_stem: dict[str, Path] = {}
+        self._resolved: dict[str, Path | None] = {}  # يشمل النتائج السلبية
+        for d in sorted(dirs, key=lambda p: p.as_posix()):
+            d_rel = _rel(d)
+            for f in dirs[d][1]:
+                stem = _norm(f.stem)
+                self.by_path[_rel(f)] = f
+                self.by_dir_stem.setdefault((d_rel, stem), f)
+                self.by_stem.setdefault(stem, f)
+
+    @classmethod
+    def build(cls, root: Path) -> "AssetIndex":
+        return cls(root, cls._walk(root, {}))
+
+    @classmethod
+    def from_state(cls, root: Path, dirs: dict, resolved: dict) -> "AssetIndex":
+        # من snapshot مُجمَّع: لا نمشي على القرص، والمسارات محلولة مسبقًا
+        index = cls(root, {
+            BASE_DIR / d: (mtime_ns, [BASE_DIR / d / n for n in files], [BASE_DIR / d / n for n in subdirs])
+            for d, (mtime_ns, files, subdirs) in dirs.items()
+        })
+        index._resolved.update({k: BASE_DIR / v if v else None for k, v in resolved.items()})
+        return index
+
+    def to_state(self) -> dict:
+        return {_rel(d): (mtime_ns, [f.name for f in files], [s.name for s in subdirs])
+                for d, (mtime_ns, files, subdirs) in self._dirs.items()}
+
+    @staticmethod
+    def _walk(root: Path, known: dict) -> dict:
+        # يعيد قائمة المجلدات، ويعيد فحص ما تغيّر mtime له فقط
+        dirs, stack = {}, [root]
+        while stack:
+            d = stack.pop()
+            try:
+                old = known.get(d)
+                if old and d.stat().st_mtime_ns == old[0]:
+                    entry = old
+                else:
+                    entry = _scan_dir(d)
+            except OSError:
+                continue
+            dirs[d] = entry
+            stack.extend(entry[2])
+        return dirs
+
+    def refreshed(self) -> "AssetIndex":
+        dirs = self._walk(self.root, self._dirs)
+        if dirs.keys() == self._dirs.keys() and all(dirs[d] is self._dirs[d] for d in dirs):
+            return self
+        return AssetIndex(self.root, dirs)
+
+    def __len__(self) -> int:
+        return len(self.by_path)
+
+    def resolve(self, rel_path: str) -> Path | None:
+        try:
+            found = self._resolved[rel_path]
+            METRICS.inc("resolve_total", (("result", "memo"),))
+            return found
+        except KeyError:
+            pass
+        found, how = self._lookup(rel_path)
+        METRICS.inc("resolve_total", (("result", how),))
+        self._resolved[rel_path] = found
+        return found
+
+    def _lookup(self, rel_path: str) -> tuple[Path | None, str]:
+        clean = os.path.normpath(rel_path.strip().replace("\\", "/")).replace("\\", "/")
+        hit = self.by_path.get(clean)
+        if hit:
+            return hit, "exact"
+
+        target = Path(clean)
+        stem = _norm(target.stem)
+        for d_rel in (target.parent.as_posix(), f"assets/{target.parent.name}", "assets"):
+            hit = self.by_dir_stem.get((d_rel, stem))
+            if hit:
+                return hit, "dir_fallback"
+        hit = self.by_stem.get(stem)
+        return hit, ("scan_fallback" if hit else "miss")
+
+def resolve_relaxed(rel_path: str) -> Path | None:
+    return ASSET_INDEX.resolve(rel_path)
+
+async def refresh_asset_index():
+    global ASSET_INDEX
+    new = await asyncio.to_thread(ASSET_INDEX.refreshed)
+    if new is not ASSET_INDEX:
+        log.info("🗂️ Asset index refreshed: %d files", len(new))
+        ASSET_INDEX = new
+        META.kick()
+
+async def asset_index_poller():
+    while True:
+        await asyncio.sleep(ASSET_INDEX_POLL)
+        try:
+            await refresh_asset_index()
+        except Exception as e:
+            log.warning("Asset index refresh failed: %s", e)
+
+# ===================== البحث في العناوين =====================
+# فهرس مقلوب من الثلاثيات (trigrams) فوق العناوين وأسماء الملفات بعد توحيد الكتابة
+# العربية (حذف التشكيل، توحيد الألف/الياء/التاء المربوطة) وتصغير الحروف اللاتينية.
+SEARCH_LIMIT = 10
+SEARCH_SCAN = 3000           # أقصى عدد مستندات نفحصها في التطابق الكامل
+SEARCH_FUZZY_BUDGET = 3000   # أقصى عدد مداخل نعدّها في التطابق التقريبي
+
+_AR_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_AR_LETTERS = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+                             "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه"})
+_NON_WORD = re.compile(r"[\W_]+")
+
+def normalize_text(s: str) -> str:
+    s = unicodedata.normalize("NFKC", s).casefold()
+    s = _AR_DIACRITICS.sub("", s).translate(_AR_LETTERS)
+    return _NON_WORD.sub(" ", s).strip()
+
+def _grams(norm: str) -> set[str]:
+    out = set()
+    for word in norm.split():
+        padded = f" {word} "
+        out.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return out
+
+class SearchIndex:
+    def __init__(self, docs: list[tuple[str, str]]):
+        # docs: (item_id, نص قابل للبحث). ترتيب المستندات = ترتيبها الثابت (الأقصر أولًا)،
+        # فتكون قوائم الثلاثيات مرتبة حسب الأفضلية ويمكن التوقف مبكرًا.
+        normed = sorted(((normalize_text(text), item_id) for item_id, text in docs),
+                        key=lambda d: len(d[0]))
+        self.ids: list[str] = [item_id for _, item_id in normed]
+        self.texts: list[str] = [norm for norm, _ in normed]
+        postings: dict[str, array] = {}
+        for doc, norm in enumerate(self.texts):
+            for g in _grams(norm):
+                postings.setdefault(g, array("I")).append(doc)
+        self.postings = postings
+
+    @classmethod
+    def from_state(cls, state: tuple) -> "SearchIndex":
+        index = cls.__new__(cls)
+        index.ids, index.texts, postings = state
+        index.postings = {}
+        for g, raw in postings.items():
+            index.postings[g] = array("I")
+            index.postings[g].frombytes(raw)
+        return index
+
+    def to_state(self) -> tuple:
+        return self.ids, self.texts, {g: docs.tobytes() for g, docs in self.postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> list[str]:
+        norm = normalize_text(query)
+        words = norm.split()
+        lists = sorted((self.postings.get(g, ()) for g in _grams(norm)), key=len)
+        if not lists:
+            return []
+
+        # 1) كل كلمات الاستعلام موجودة: نمشي على أندر قائمة بترتيبها الثابت ونتوقف عند الاكتفاء
+        texts = self.texts
+        hits = []
+        if len(words) == 1:
+            word = words[0]
+            for doc in islice(lists[0], SEARCH_SCAN):
+                if word in texts[doc]:
+                    hits.append(doc)
+                    if len(hits) >= limit:
+                        break
+        else:
+            for doc in islice(lists[0], SEARCH_SCAN):
+                text = texts[doc]
+                for w in words:
+                    if w not in text:
+                        break
+                else:
+                    hits.append(doc)
+                    if len(hits) >= limit:
+                        break
+        hits.sort(key=lambda doc: (not texts[doc].startswith(norm), doc))
+
+        # 2) تطابق تقريبي (أخطاء إملائية) بعدد الثلاثيات المشتركة، بميزانية محدودة
+        if len(hits) < limit:
+            # ثلث ثلاثيات الاستعلام على الأقل (خطأ حرفين في كلمة قصيرة يُسقط أكثر من نصفها)،
+            # والثلاثيات التي لا تظهر في أي عنوان تبقى ضمن المقام: هي أخطاء لا تطابقات
+            need = max(2, (len(lists) + 2) // 3) if len(lists) > 2 else len(lists)
+            nonempty = [docs for docs in lists if docs]
+            counts = Counter()
+            if len(nonempty) >= need:
+                # نعدّ كل القوائم على البادئة نفسها من المستندات (الأقصر أولًا) التي تتسع لها
+                # الميزانية، فيكون العدد دقيقًا لكل مستند داخلها
+                cutoff = len(self.ids)
+                if sum(map(len, nonempty)) > SEARCH_FUZZY_BUDGET:
+                    lo, hi = 0, cutoff
+                    while lo < hi:
+                        mid = (lo + hi + 1) // 2
+                        if sum(bisect_left(docs, mid) for docs in nonempty) <= SEARCH_FUZZY_BUDGET:
+                            lo = mid
+                        else:
+                            hi = mid - 1
+                    cutoff = lo
+                counts.update(chain.from_iterable(
+                    islice(docs, bisect_left(docs, cutoff)) for docs in nonempty))
+            for doc in hits:
+                counts.pop(doc, None)
+            if counts:
+                # لا نعرض إلا ما يقارب أفضل تطابق، لا كل ما يشاركه في ثلاثيتين
+                floor = max(need, max(counts.values()) - 1)
+                found = [doc for doc, c in counts.items() if c >= floor]
+                found.sort(key=lambda doc: (-counts[doc], doc))
+                hits += found[:limit - len(hits)]
+        return [self.ids[doc] for doc in hits]
+
 # ===================== تحميل الكتالوج =====================
-def load_catalog() -> dict:
+# الكتالوج يُحمَّل في خيط منفصل، يُتحقق من بنيته ومن وجود ملفاته، ثم يُبنى منه
+# snapshot غير قابل للتعديل يُبدَّل بإسناد واحد. الطلبات الجارية تكمل على النسخة القديمة.
+CATALOG_WATCH_SECONDS = float(os.getenv("CATALOG_WATCH_SECONDS", "30"))  # 0 = معطّل
+
+class CatalogError(ValueError):
+    pass
+
+def _catalog_file() -> Path:
     cat_file = BASE_DIR / CATALOG_PATH
     if not cat_file.exists():
         alt = BASE_DIR / "catalog.json"
         if alt.exists():
             cat_file = alt
-    log.info("📘 Using catalog file: %s", cat_file.as_posix())
-    with cat_file.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-    stats = {k: (len(v) if isinstance(v, list) else len(v.get("children", [])))
-             for k, v in data.items()}
-    log.info("📦 Catalog on start: %s", stats)
+    return cat_file
+
+def validate_catalog(data) -> list[str]:
+    problems = []
+    if not isinstance(data, dict):
+        return ["catalog root must be an object of sections"]
+
+    def check_file(itm, where):
+        if not isinstance(itm, dict):
+            problems.append(f"{where}: item must be an object")
+        elif not isinstance(itm.get("title"), str) or not itm["title"].strip():
+            problems.append(f"{where}: missing title")
+        elif not isinstance(itm.get("path"), str) or not itm["path"].strip():
+            problems.append(f"{where}: missing path")
+
+    for section, items in data.items():
+        if not isinstance(items, list):
+            problems.append(f"{section}: must be a list")
+            continue
+        for i, itm in enumerate(items):
+            where = f"{section}[{i}]"
+            if isinstance(itm, dict) and "children" in itm:
+                if not isinstance(itm.get("title"), str) or not itm["title"].strip():
+                    problems.append(f"{where}: missing title")
+                if not isinstance(itm["children"], list) or not itm["children"]:
+                    problems.append(f"{where}: children must be a non-empty list")
+                    continue
+                for j, child in enumerate(itm["children"]):
+                    check_file(child, f"{where}.children[{j}]")
+            else:
+                check_file(itm, where)
+    return problems
+
+def _freeze(obj):
+    if isinstance(obj, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in obj.items()})
+    if isinstance(obj, list):
+        return tuple(_freeze(v) for v in obj)
+    return obj
+
+def iter_files(items):
+    for itm in items:
+        if "children" in itm:
+            yield from itm["children"]
+        else:
+            yield itm
+
+def _item_key(itm) -> str:
+    return f"series:{itm['title']}" if "children" in itm else itm["path"]
+
+def _short_id(key: str, taken: dict[str, str]) -> str:
+    # معرّف ثابت قصير (8 أحرف) مشتق من المسار، يصلح لـ callback_data (حد 64 بايت)
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=12).digest()
+    for n in (6, 9, 12):
+        sid = base64.urlsafe_b64encode(digest[:n]).decode("ascii")
+        if taken.setdefault(sid, key) == key:
+            return sid
+    raise CatalogError(f"id collision: {key}")
+
+class CatalogSnapshot(Mapping):
+    def __init__(self, sections: dict, version: int, index: AssetIndex, source_mtime_ns: int = 0,
+                 search: SearchIndex | None = None, meta: dict | None = None):
+        self.version = version
+        self.index = index
+        self.source_mtime_ns = source_mtime_ns
+        self._meta_by_path = meta or {}
+        self.files: dict[str, Mapping] = {}                 # id -> عنصر ملف
+        self.series: dict[str, tuple[str, Mapping]] = {}    # id -> (section, عنصر سلسلة)
+        self.assets: dict[str, Path | None] = {}            # id -> الملف على القرص
+        self.meta: dict[str, tuple[int, int, str]] = {}     # id -> (الحجم، mtime_ns، sha256) وقت التجميع
+        self._by_path: dict[str, str] = {}
+        self._taken: dict[str, str] = {}
+        self.labels: dict[str, str] = {}                    # id -> عنوان العرض في نتائج البحث
+        docs: list[tuple[str, str]] = []
+
+        frozen = {}
+        for section, items in sections.items():
+            out = []
+            for itm in items:
+                if "children" in itm:
+                    sid = _short_id(f"series:{section}:{itm['title']}", self._taken)
+                    children = [self._add_file(c) for c in itm["children"]]
+                    for c in children:
+                        self.labels.setdefault(c["id"], f"{itm['title']} · {c['title']}")
+                        docs.append((c["id"], f"{itm['title']} {c['title']} {Path(c['path']).stem}"))
+                    series = _freeze({**itm, "id": sid, "children": children})
+                    self.series[sid] = (section, series)
+                    out.append(series)
+                else:
+                    f = self._add_file(itm)
+                    self.labels.setdefault(f["id"], f["title"])
+                    docs.append((f["id"], f"{f['title']} {Path(f['path']).stem}"))
+                    out.append(f)
+            frozen[section] = tuple(out)
+        self._sections = MappingProxyType(frozen)
+        self.files = MappingProxyType(self.files)
+        self.series = MappingProxyType(self.series)
+        self.assets = MappingProxyType(self.assets)
+        self.labels = MappingProxyType(self.labels)
+        self.meta = MappingProxyType(self.meta)
+        self.missing = tuple(self.files[i]["path"] for i, p in self.assets.items() if p is None)
+        if search is None:
+            seen = set()
+            search = SearchIndex([d for d in docs if not (d[0] in seen or seen.add(d[0]))])
+        self.search = search
+
+    def _add_file(self, itm: dict) -> Mapping:
+        fid = _short_id(itm["path"], self._taken)
+        if fid not in self.files:
+            self.files[fid] = _freeze({**itm, "id": fid})
+            self.assets[fid] = self.index.resolve(itm["path"])
+            self._by_path[itm["path"]] = fid
+            if itm["path"] in self._meta_by_path:
+                self.meta[fid] = self._meta_by_path[itm["path"]]
+        return self.files[fid]
+
+    def sha256(self, fid: str, path: Path) -> str | None:
+        # البصمة المحسوبة وقت التجميع، ما دام الملف لم يتغير حجمه أو توقيته
+        meta = self.meta.get(fid)
+        if meta:
+            st = path.stat()
+            if (st.st_size, st.st_mtime_ns) == tuple(meta[:2]):
+                return meta[2]
+        return None
+
+    def find_file(self, token: str) -> Mapping | None:
+        # token معرّف، أو مسار كامل من أزرار أُرسلت قبل اعتماد المعرّفات
+        return self.files.get(token) or self.files.get(self._by_path.get(token, ""))
+
+    def find_series(self, token: str) -> tuple[str, Mapping] | None:
+        hit = self.series.get(token)
+        if hit or token not in self._sections:
+            return hit
+        # صيغة قديمة: series|<section> = أول سلسلة في القسم
+        return next(((token, i) for i in self._sections[token] if "children" in i), None)
+
+    def __getitem__(self, key):
+        return self._sections[key]
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __len__(self) -> int:
+        return len(self._sections)
+
+    def stats(self) -> dict[str, int]:
+        return {k: len(v) for k, v in self._sections.items()}
+
+def diff_catalogs(old: Mapping, new: Mapping) -> dict:
+    diff = {"added": [], "removed": [], "changed": [], "sections": set()}
+    for section in old.keys() | new.keys():
+        old_items = {_item_key(i): i for i in old.get(section, ())}
+        new_items = {_item_key(i): i for i in new.get(section, ())}
+        added = new_items.keys() - old_items.keys()
+        removed = old_items.keys() - new_items.keys()
+        changed = [k for k in new_items.keys() & old_items.keys() if new_items[k] != old_items[k]]
+        diff["added"] += sorted(added)
+        diff["removed"] += sorted(removed)
+        diff["changed"] += sorted(changed)
+        if added or removed or changed or tuple(old.get(section, ())) != tuple(new.get(section, ())):
+            diff["sections"].add(section)
+    return diff
+
+def _parse_catalog(raw: bytes) -> dict:
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise CatalogError(f"invalid JSON: {e}") from e
+    problems = validate_catalog(data)
+    if problems:
+        raise CatalogError("; ".join(problems[:10]))
     return data
 
-CATALOG = load_catalog()
+# ----- snapshot مُجمَّع وقت البناء -----
+# `python bot.py compile-catalog` يتحقق من الكتالوج ويحل كل مساراته ويحسب حجم/توقيت/بصمة
+# كل ملف ويبني فهرس البحث، ثم يكتب ذلك بصيغة marshal. عند الإقلاع يُحمَّل كما هو إن طابقت
+# بصمة catalog.json، بلا تحليل JSON ولا مشي على مجلد assets ولا بناء فهرس البحث.
+CATALOG_SNAPSHOT = os.getenv("CATALOG_SNAPSHOT", str(BASE_DIR / "assets" / "catalog.snapshot"))  # "" = معطّل
+SNAPSHOT_FORMAT = 1
 
-# ===================== Health server =====================
-class Healthz(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == "/healthz":
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(b"ok")
-        else:
-            self.send_response(404)
-            self.end_headers()
+def _snapshot_header(raw: bytes) -> dict:
+    return {"format": SNAPSHOT_FORMAT, "python": tuple(sys.version_info[:2]),
+            "source_sha256": hashlib.sha256(raw).hexdigest()}
 
-def start_health_server():
-    port = int(os.getenv("PORT", "10000"))
-    HTTPServer(("0.0.0.0", port), Healthz).serve_forever()
+def _load_compiled(raw: bytes, version: int, mtime_ns: int) -> CatalogSnapshot | None:
+    if not CATALOG_SNAPSHOT:
+        return None
+    try:
+        with open(CATALOG_SNAPSHOT, "rb") as f:
+            state = marshal.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError) as e:
+        log.warning("Catalog snapshot unreadable, loading JSON: %s", e)
+        return None
+    header = _snapshot_header(raw)
+    if not isinstance(state, dict) or any(state.get(k) != v for k, v in header.items()):
+        log.info("Catalog snapshot is stale, loading JSON")
+        return None
+    index = AssetIndex.from_state(ASSETS_DIR, state["dirs"], state["resolved"])
+    # المسارات المحلولة وقت التجميع لا تصلح إلا إذا لم تتغير المجلدات بعده (ملفات رُفعت أو
+    # حُذفت قبل /reload مثلًا): عندها فهرس جديد من القرص، والمسارات و missing تُحل من جديد
+    index = index.refreshed()
+    log.info("⚡ Catalog loaded from compiled snapshot")
+    return CatalogSnapshot(state["sections"], version, index, mtime_ns,
+                           search=SearchIndex.from_state(state["search"]), meta=state["meta"])
+
+def compile_catalog(out: str = CATALOG_SNAPSHOT, allow_missing: bool = False) -> CatalogSnapshot:
+    if not out:
+        raise CatalogError("CATALOG_SNAPSHOT is empty")
+    cat_file = _catalog_file()
+    raw = cat_file.read_bytes()
+    data = _parse_catalog(raw)
+    index = AssetIndex.build(ASSETS_DIR)
+    snap = CatalogSnapshot(data, 0, index, cat_file.stat().st_mtime_ns)
+    if snap.missing and not allow_missing:
+        raise CatalogError(f"{len(snap.missing)} paths not found: {', '.join(snap.missing)}")
+    meta = {}
+    for fid, p in snap.assets.items():
+        if p:
+            st = p.stat()
+            meta[snap.files[fid]["path"]] = (st.st_size, st.st_mtime_ns, _file_sha256(p))
+    state = {
+        **_snapshot_header(raw),
+        "sections": data,
+        "dirs": index.to_state(),
+        "resolved": {snap.files[fid]["path"]: _rel(p) if p else None for fid, p in snap.assets.items()},
+        "meta": meta,
+        "search": snap.search.to_state(),
+    }
+    tmp = f"{out}.tmp"
+    with open(tmp, "wb") as f:
+        marshal.dump(state, f)
+    os.replace(tmp, out)
+    return snap
+
+def load_catalog(version: int = 0) -> CatalogSnapshot:
+    cat_file = _catalog_file()
+    log.info("📘 Using catalog file: %s", cat_file.as_posix())
+    mtime_ns = cat_file.stat().st_mtime_ns
+    raw = cat_file.read_bytes()
+    snap = _load_compiled(raw, version, mtime_ns)
+    if snap is None:
+        snap = CatalogSnapshot(_parse_catalog(raw), version, AssetIndex.build(ASSETS_DIR), mtime_ns)
+    log.info("📦 Catalog v%d: %s", version, snap.stats())
+    log.info("🗂️ Asset index: %d files", len(snap.index))
+    if snap.missing:
+        log.warning("Catalog paths not found on disk (%d): %s", len(snap.missing), ", ".join(snap.missing))
+    return snap
 
-def start_health_thread():
-    Thread(target=start_health_server, daemon=True).start()
-    log.info("🌐 Health server on 0.0.0.0:%s", os.getenv("PORT", "10000"))
+CATALOG = load_catalog()
+ASSET_INDEX = CATALOG.index
+
+def install_catalog(snap: CatalogSnapshot) -> dict:
+    global CATALOG, ASSET_INDEX
+    old = CATALOG
+    diff = diff_catalogs(old, snap)
+    CATALOG, ASSET_INDEX = snap, snap.index
+    invalidate_kb(diff["sections"], main=old.keys() != snap.keys())
+    return diff
+
+async def reload_catalog() -> dict:
+    snap = await asyncio.to_thread(load_catalog, CATALOG.version + 1)
+    diff = install_catalog(snap)
+    await warm_keyboards(diff["sections"])
+    META.kick()
+    return diff
+
+async def catalog_watcher():
+    seen = CATALOG.source_mtime_ns
+    while True:
+        await asyncio.sleep(CATALOG_WATCH_SECONDS)
+        try:
+            mtime_ns = await asyncio.to_thread(lambda: _catalog_file().stat().st_mtime_ns)
+            if mtime_ns in (seen, CATALOG.source_mtime_ns):
+                continue
+            # نسجّل التوقيت قبل المحاولة: الملف المرفوض لا يُعاد تحميله حتى يتغير مجددًا
+            seen = mtime_ns
+            diff = await reload_catalog()
+            log.info("🔄 Catalog auto-reloaded: +%d -%d ~%d",
+                     len(diff["added"]), len(diff["removed"]), len(diff["changed"]))
+        except CatalogError as e:
+            log.error("Catalog auto-reload rejected: %s", e)
+        except Exception as e:
+            log.warning("Catalog watch failed: %s", e)
+
+# ===================== خادم HTTP (healthz + webhook) =====================
+# خادم HTTP/1.1 صغير يعمل على حلقة asyncio نفسها التي يعمل عليها البوت.
+PORT = int(os.getenv("PORT", "10000"))
+HTTP_MAX_BODY = 1 << 20
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 413: "Payload Too Large"}
+
+class HttpServer:
+    def __init__(self):
+        # (method, path) -> async handler(headers, body) -> (status, content_type, body)
+        self.routes: dict[tuple[str, str], object] = {}
+        self._server: asyncio.Server | None = None
+        self._conns: set[asyncio.StreamWriter] = set()
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host: str = "0.0.0.0", port: int = PORT):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        log.info("🌐 HTTP server on %s:%s", host, port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # اتصالات keep-alive الخاملة تبقى مفتوحة بعد close(): نغلقها حتى تنتهي معالجاتها
+            for writer in list(self._conns):
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._conns.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length") or 0)
+                if length > HTTP_MAX_BODY:
+                    await self._respond(writer, 413, b"", keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                path = path.split("?", 1)[0]
+                handler = self.routes.get((method if method != "HEAD" else "GET", path))
+                if handler:
+                    status, ctype, payload = await handler(headers, body)
+                elif any(p == path for _, p in self.routes):
+                    status, ctype, payload = 405, "text/plain", b""
+                else:
+                    status, ctype, payload = 404, "text/plain", b""
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, b"" if method == "HEAD" else payload,
+                                    ctype, keep_alive)
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            log.error("HTTP handler error: %s", e, exc_info=True)
+        finally:
+            self._conns.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer, status: int, body: bytes, ctype: str = "text/plain",
+                       keep_alive: bool = True):
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {ctype}; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+async def healthz(headers: dict, body: bytes):
+    return 200, "text/plain", b"ok"
+
+async def metrics_endpoint(headers: dict, body: bytes):
+    return 200, "text/plain; version=0.0.4", METRICS.render().encode("utf-8")
 
 # ===================== أدوات لغة/قوائم =====================
 def ulang(update: Update) -> str:
     uid = update.effective_user.id if update.effective_user else 0
-    return USER_LANG.get(uid, "ar")
+    return USERS.get(uid).lang
 
 def t(update: Update, key: str) -> str:
     return L[ulang(update)].get(key, key)
@@ -163,33 +1036,62 @@ def t(update: Update, key: str) -> str:
 def section_label(update: Update, key: str) -> str:
     return L[ulang(update)]["sections"].get(key, key)
 
-def bottom_keyboard(update: Update) -> ReplyKeyboardMarkup:
-    s = L[ulang(update)]["sections"]
+# ===================== كاش لوحات المفاتيح =====================
+# اللوحات لا تعتمد إلا على (اللغة، الشاشة، الكتالوج)، وكائنات تيليجرام غير قابلة
+# للتعديل، لذا نبني كل لوحة مرة واحدة ونعيد استخدامها حتى يتغير قسمها في الكتالوج.
+_KB_CACHE: dict[tuple, object] = {}  # (screen, lang, *args) -> markup
+
+def cached_kb(key: tuple, build, cat=None):
+    if cat is not None and cat is not CATALOG:
+        # معالج بدأ على نسخة سابقة من الكتالوج: نبني لها دون أن نلوّث الكاش
+        return build()
+    kb = _KB_CACHE.get(key)
+    if kb is None:
+        kb = _KB_CACHE[key] = build()
+    return kb
+
+def invalidate_kb(sections: set[str] | None = None, main: bool = False):
+    if sections is None:
+        _KB_CACHE.clear()
+        return
+    for key in list(_KB_CACHE):
+        if (main and key[0] == "main") or (len(key) > 2 and key[2] in sections):
+            del _KB_CACHE[key]
+
+def _bottom_keyboard(lang: str) -> ReplyKeyboardMarkup:
+    s = L[lang]["sections"]
     rows = [
         [KeyboardButton(s["prog"]), KeyboardButton(s["design"])],
         [KeyboardButton(s["security"]), KeyboardButton(s["languages"])],
         [KeyboardButton(s["marketing"]), KeyboardButton(s["maintenance"])],
         [KeyboardButton(s["office"])],
-        [KeyboardButton(L[ulang(update)]["change_language"]),
-         KeyboardButton(L[ulang(update)]["contact_short"])],
-        [KeyboardButton(L[ulang(update)]["start"])],
-        [KeyboardButton(L[ulang(update)]["myinfo"]),
-         KeyboardButton(L[ulang(update)]["greet"])],
+        [KeyboardButton(L[lang]["change_language"]),
+         KeyboardButton(L[lang]["contact_short"])],
+        [KeyboardButton(L[lang]["start"])],
+        [KeyboardButton(L[lang]["myinfo"]),
+         KeyboardButton(L[lang]["greet"])],
     ]
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
-def contact_inline_button(update: Update):
+def bottom_keyboard(update: Update) -> ReplyKeyboardMarkup:
+    lang = ulang(update)
+    return cached_kb(("bottom", lang), lambda: _bottom_keyboard(lang))
+
+def _contact_button(lang: str):
     if OWNER_USERNAME:
-        return InlineKeyboardButton(L[ulang(update)]["contact"],
+        return InlineKeyboardButton(L[lang]["contact"],
                                     url=f"https://t.me/{OWNER_USERNAME}")
     return None
 
-def main_menu_inline(update: Update) -> InlineKeyboardMarkup:
+def contact_inline_button(update: Update):
+    return _contact_button(ulang(update))
+
+def _main_menu(lang: str) -> InlineKeyboardMarkup:
     order = ["prog", "design", "security", "languages", "marketing", "maintenance", "office"]
     rows, row = [], []
     for key in order:
         if key in CATALOG:
-            row.append(InlineKeyboardButton(section_label(update, key), callback_data=f"cat|{key}"))
+            row.append(InlineKeyboardButton(L[lang]["sections"].get(key, key), callback_data=f"cat|{key}"))
             if len(row) == 2:
                 rows.append(row); row = []
     if row: rows.append(row)
@@ -198,113 +1100,727 @@ def main_menu_inline(update: Update) -> InlineKeyboardMarkup:
         InlineKeyboardButton("🇬🇧 English", callback_data="lang|en"),
     ]
     rows.append(lang_row)
-    btn = contact_inline_button(update)
+    btn = _contact_button(lang)
     if btn:
         rows.append([btn])
     return InlineKeyboardMarkup(rows)
 
-def build_section_kb(section: str, update: Update) -> InlineKeyboardMarkup:
-    items = CATALOG.get(section, [])
+def main_menu_inline(update: Update) -> InlineKeyboardMarkup:
+    lang = ulang(update)
+    return cached_kb(("main", lang), lambda: _main_menu(lang))
+
+# الأقسام والسلاسل الكبيرة تُقسَّم إلى صفحات، ورقم الصفحة يُحمل في callback_data
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+
+def page_count(n: int) -> int:
+    return max(1, -(-n // PAGE_SIZE))
+
+def clamp_page(page: int, n: int) -> int:
+    return min(max(page, 0), page_count(n) - 1)
+
+def _nav_row(prefix: str, page: int, n: int) -> list[InlineKeyboardButton]:
+    pages = page_count(n)
+    if pages == 1:
+        return []
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}|{page - 1}"))
+    row.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+    if page < pages - 1:
+        row.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}|{page + 1}"))
+    return row
+
+def _section_kb(section: str, lang: str, page: int, cat: CatalogSnapshot) -> InlineKeyboardMarkup:
+    items = cat.get(section, ())
     rows = []
-    for itm in items:
+    for itm in items[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
         if "children" in itm:
             title = itm.get("title", "Series")
-            rows.append([InlineKeyboardButton(f"📚 {title}", callback_data=f"series|{section}")])
+            rows.append([InlineKeyboardButton(f"📚 {title}", callback_data=f"series|{itm['id']}")])
         else:
             title = itm.get("title", "file")
-            path = itm.get("path", "")
-            rows.append([InlineKeyboardButton(f"📄 {title}", callback_data=f"file|{path}")])
-    rows.append([InlineKeyboardButton(L[ulang(update)]["back"], callback_data="back|main")])
+            rows.append([InlineKeyboardButton(f"📄 {title}{file_badge(itm, lang, cat)}",
+                                              callback_data=f"file|{itm['id']}")])
+    nav = _nav_row(f"cat|{section}", page, len(items))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(L[lang]["back"], callback_data="back|main")])
     return InlineKeyboardMarkup(rows)
 
-def build_series_kb(section: str, update: Update) -> InlineKeyboardMarkup:
-    series = None
-    for itm in CATALOG.get(section, []):
-        if "children" in itm:
-            series = itm["children"]; break
+def build_section_kb(section: str, update: Update, page: int = 0, cat=None) -> InlineKeyboardMarkup:
+    lang = ulang(update)
+    cat = CATALOG if cat is None else cat
+    page = clamp_page(page, len(cat.get(section, ())))
+    return cached_kb(("section", lang, section, page), lambda: _section_kb(section, lang, page, cat), cat)
+
+def _series_kb(section: str, series: Mapping, lang: str, page: int, cat: CatalogSnapshot) -> InlineKeyboardMarkup:
+    children = series["children"]
     rows = []
-    if series:
-        for child in series:
-            rows.append([InlineKeyboardButton(f"📘 {child.get('title','part')}",
-                                              callback_data=f"file|{child.get('path','')}")])
-    rows.append([InlineKeyboardButton(L[ulang(update)]["back"], callback_data=f"cat|{section}")])
+    for child in children[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        rows.append([InlineKeyboardButton(f"📘 {child.get('title','part')}{file_badge(child, lang, cat)}",
+                                          callback_data=f"file|{child['id']}")])
+    nav = _nav_row(f"series|{series['id']}", page, len(children))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(L[lang]["bundle"], callback_data=f"zip|{series['id']}")])
+    # الرجوع إلى صفحة القسم التي فيها السلسلة
+    items = cat.get(section, ())
+    back_page = next((i for i, itm in enumerate(items) if itm is series), 0) // PAGE_SIZE
+    rows.append([InlineKeyboardButton(L[lang]["back"], callback_data=f"cat|{section}|{back_page}")])
     return InlineKeyboardMarkup(rows)
 
+def build_series_kb(section: str, series: Mapping, update: Update, page: int = 0,
+                    cat=None) -> InlineKeyboardMarkup:
+    lang = ulang(update)
+    cat = CATALOG if cat is None else cat
+    page = clamp_page(page, len(series["children"]))
+    return cached_kb(("series", lang, section, series["id"], page),
+                     lambda: _series_kb(section, series, lang, page, cat), cat)
+
+async def warm_keyboards(sections):
+    # بناء كل صفحات الأقسام المتغيرة مسبقًا، قسمًا قسمًا حتى لا نحجز الحلقة
+    cat = CATALOG
+    for section in sections:
+        items = cat.get(section, ())
+        for lang in L:
+            for page in range(page_count(len(items))):
+                cached_kb(("section", lang, section, page), lambda: _section_kb(section, lang, page, cat), cat)
+            for series in (i for i in items if "children" in i):
+                for page in range(page_count(len(series["children"]))):
+                    cached_kb(("series", lang, section, series["id"], page),
+                              lambda: _series_kb(section, series, lang, page, cat), cat)
+        await asyncio.sleep(0)
+        if cat is not CATALOG:  # استُبدل الكتالوج أثناء التسخين
+            return
+
 # ===================== اشتراك القناة =====================
+# نتيجة get_chat_member تُحفظ لمدة مختلفة للمشترك وغير المشترك، والطلبات المتزامنة
+# لنفس المستخدم تنتظر طلبًا واحدًا. تحديثات chat_member تُسقط السجل فورًا.
+MEMBER_TTL = float(os.getenv("MEMBER_TTL", "600"))
+NONMEMBER_TTL = float(os.getenv("NONMEMBER_TTL", "30"))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "50000"))
+# عند تعذّر التحقق: 1 = السماح (السلوك القديم)، 0 = المنع
+MEMBERSHIP_FAIL_OPEN = os.getenv("MEMBERSHIP_FAIL_OPEN", "1") != "0"
+
+class MembershipCache:
+    def __init__(self, capacity: int = MEMBER_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries: OrderedDict[int, tuple[bool, float]] = OrderedDict()  # uid -> (عضو؟, ينتهي في)
+        self._inflight: dict[int, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def invalidate(self, uid: int):
+        self._entries.pop(uid, None)
+
+    def _store(self, uid: int, is_member: bool):
+        ttl = MEMBER_TTL if is_member else NONMEMBER_TTL
+        self._entries[uid] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(uid)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    # True/False، أو None إذا فشل الطلب
+    async def check(self, bot, uid: int) -> bool | None:
+        entry = self._entries.get(uid)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        fut = self._inflight.get(uid)
+        if fut:
+            return await asyncio.shield(fut)
+
+        fut = self._inflight[uid] = asyncio.get_running_loop().create_future()
+        is_member = None
+        try:
+            member = await bot.get_chat_member(REQUIRED_CHANNEL, uid)
+            is_member = getattr(member, "status", "left") not in ("left", "kicked")
+            self._store(uid, is_member)
+        except Exception as e:
+            log.warning("Membership check failed for %s: %s", uid, e)
+        finally:
+            # حتى لو أُلغي القائد: المنتظرون يأخذون None (فشل الطلب) بدل الانتظار للأبد
+            del self._inflight[uid]
+            fut.set_result(is_member)
+        return is_member
+
+MEMBERSHIP = MembershipCache()
+
+def _is_required_channel(chat) -> bool:
+    ch = REQUIRED_CHANNEL.lower()
+    return ch in (str(chat.id), f"@{(chat.username or '').lower()}")
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cm = update.chat_member
+    if cm and _is_required_channel(cm.chat):
+        MEMBERSHIP.invalidate(cm.new_chat_member.user.id)
+
 async def ensure_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     if not REQUIRED_CHANNEL:
         return True
     user = update.effective_user
     if not user:
         return False
-    try:
-        member = await context.bot.get_chat_member(REQUIRED_CHANNEL, user.id)
-        status = getattr(member, "status", "left")
-        if status in ("left", "kicked"):
-            kb = [
-                [InlineKeyboardButton(L[ulang(update)]["join_channel"],
-                                      url=f"https://t.me/{REQUIRED_CHANNEL.lstrip('@')}")],
-                [InlineKeyboardButton(L[ulang(update)]["verify"], callback_data="verify")],
-            ]
-            await update.effective_message.reply_text(
-                L[ulang(update)]["must_join"], reply_markup=InlineKeyboardMarkup(kb)
-            )
-            return False
+    is_member = await MEMBERSHIP.check(context.bot, user.id)
+    if is_member is None:
+        is_member = MEMBERSHIP_FAIL_OPEN
+    if is_member:
         return True
-    except Exception:
-        return True
-
-# ===================== حل ذكي لمسارات الملفات =====================
-def _norm(s: str) -> str:
-    return "".join(ch.lower() for ch in s if ch.isalnum())
+    kb = [
+        [InlineKeyboardButton(L[ulang(update)]["join_channel"],
+                              url=f"https://t.me/{REQUIRED_CHANNEL.lstrip('@')}")],
+        [InlineKeyboardButton(L[ulang(update)]["verify"], callback_data="verify")],
+    ]
+    await update.effective_message.reply_text(
+        L[ulang(update)]["must_join"], reply_markup=InlineKeyboardMarkup(kb)
+    )
+    return False
+
+# ===================== كاش file_id =====================
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# يحفظ file_id الذي يعيده تيليجرام لكل ملف حتى لا نرفعه مرة أخرى.
+# المفتاح مسار الملف نسبةً إلى BASE_DIR، ويُحذف السجل إذا تغيّر الحجم أو المحتوى.
+class FileIdCache:
+
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids ("
+            " path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+            " sha256 TEXT, file_id TEXT)"
+        )
+        self._db.commit()
+        # نسخة في الذاكرة حتى لا تلمس القراءات القرص
+        self._mem: dict[str, tuple[int, int, str, str]] = {
+            row[0]: tuple(row[1:])
+            for row in self._db.execute("SELECT path, size, mtime_ns, sha256, file_id FROM file_ids")
+        }
+
+    @staticmethod
+    def key(path: Path) -> str:
+        return path.relative_to(BASE_DIR).as_posix()
+
+    def __len__(self) -> int:
+        return len(self._mem)
+
+    def peek(self, path: Path) -> str | None:
+        # بدون التحقق من الملف ولا القاعدة؛ لمن يحتاج جوابًا فوريًا مثل الوضع المضمّن
+        entry = self._mem.get(self.key(path))
+        return entry[3] if entry else None
+
+    async def _entry(self, key: str) -> tuple[int, int, str, str] | None:
+        entry = self._mem.get(key)
+        if entry is None:
+            # مع BOT_WORKERS>1 قد يكون عامل آخر رفع الملف وكتب file_id في القاعدة المشتركة
+            entry = await asyncio.to_thread(self._load, key)
+            if entry is not None:
+                self._mem[key] = entry
+        return entry
+
+    def _load(self, key: str) -> tuple[int, int, str, str] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, sha256, file_id FROM file_ids WHERE path = ?", (key,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    # سجلات مفتاحها بصمة المحتوى نفسها (مثل حزم ZIP)، فلا تحتاج تحققًا من الملف
+    async def get_key(self, key: str) -> str | None:
+        entry = await self._entry(key)
+        return entry[3] if entry else None
+
+    async def put_key(self, key: str, file_id: str, size: int = 0, sha: str = ""):
+        await self._write(key, (size, 0, sha, file_id))
+
+    async def get(self, path: Path) -> str | None:
+        key = self.key(path)
+        entry = await self._entry(key)
+        if not entry:
+            return None
+        size, mtime_ns, sha, file_id = entry
+        st = path.stat()
+        if st.st_size != size:
+            await self.drop(path)
+            return None
+        if st.st_mtime_ns != mtime_ns:
+            # تغيّر التوقيت فقط: نتحقق من المحتوى قبل الحكم على السجل
+            if await asyncio.to_thread(_file_sha256, path) != sha:
+                await self.drop(path)
+                return None
+            await self._write(key, (size, st.st_mtime_ns, sha, file_id))
+        return file_id
+
+    async def put(self, path: Path, file_id: str, sha: str | None = None):
+        st = path.stat()
+        if sha is None:
+            sha = await asyncio.to_thread(_file_sha256, path)
+        await self._write(self.key(path), (st.st_size, st.st_mtime_ns, sha, file_id))
+
+    async def drop(self, path: Path):
+        await self.drop_key(self.key(path))
+
+    async def drop_key(self, key: str):
+        if self._mem.pop(key, None) is not None:
+            await asyncio.to_thread(self._exec, "DELETE FROM file_ids WHERE path = ?", (key,))
+
+    async def _write(self, key: str, entry: tuple[int, int, str, str]):
+        self._mem[key] = entry
+        await asyncio.to_thread(
+            self._exec,
+            "INSERT OR REPLACE INTO file_ids (path, size, mtime_ns, sha256, file_id) VALUES (?, ?, ?, ?, ?)",
+            (key, *entry),
+        )
 
-ALLOWED_EXTS = {".pdf", ".zip", ".rar"}
+    def _exec(self, sql: str, params: tuple):
+        with self._lock, self._db:
+            self._db.execute(sql, params)
+
+FILE_IDS = FileIdCache(FILE_ID_DB)
+
+# ===================== خط الرفع =====================
+# الملفات تُرفع بالبث من القرص (httpx يقرأ 64KB في كل مرة) بدل تحميلها كاملة في الذاكرة،
+# مع حد لعدد الرفعات المتزامنة ولمجموع أحجامها؛ الزائد ينتظر دوره ويرى "جارٍ التحضير…".
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "3"))
+UPLOAD_MAX_INFLIGHT_MB = float(os.getenv("UPLOAD_MAX_INFLIGHT_MB", "100"))
+# حد sendDocument في Bot API العام؛ خادم Bot API محلي يسمح بأكثر
+BOT_UPLOAD_LIMIT_MB = float(os.getenv("BOT_UPLOAD_LIMIT_MB", "50"))
+BOT_UPLOAD_LIMIT = int(BOT_UPLOAD_LIMIT_MB * 1024 * 1024)
+
+class UploadPipeline:
+    def __init__(self, concurrency: int = UPLOAD_CONCURRENCY,
+                 max_bytes: int = int(UPLOAD_MAX_INFLIGHT_MB * 1024 * 1024)):
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self._cond = asyncio.Condition()
+        self.active = 0
+        self.inflight_bytes = 0
+        self.waiting = 0
+        self.uploads = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.upload_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _fits(self, size: int) -> bool:
+        # ملف أكبر من الميزانية كلها يمر وحده
+        return self.active < self.concurrency and (
+            self.inflight_bytes + size <= self.max_bytes or self.active == 0
+        )
 
-def resolve_relaxed(rel_path: str) -> Path | None:
-    rel_path = rel_path.strip().replace("\\", "/")
-    p = (BASE_DIR / rel_path).resolve()
-    if p.exists():
-        return p
-
-    target = Path(rel_path)
-    target_dir = (BASE_DIR / target.parent).resolve()
-    target_stem_norm = _norm(target.stem)
-
-    search_dirs = []
-    if target_dir.exists():
-        search_dirs.append(target_dir)
-    assets_dir = BASE_DIR / "assets" / target.parent.name
-    if assets_dir.exists() and assets_dir not in search_dirs:
-        search_dirs.append(assets_dir)
-    just_assets = BASE_DIR / "assets"
-    if just_assets.exists() and just_assets not in search_dirs:
-        search_dirs.append(just_assets)
-
-    for d in search_dirs:
+    async def acquire(self, size: int, on_wait=None):
+        started = time.monotonic()
+        if not self._fits(size) and on_wait:
+            await on_wait()
+        async with self._cond:
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self._fits(size))
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.inflight_bytes += size
+        self.wait_seconds += time.monotonic() - started
+
+    async def release(self, size: int):
+        async with self._cond:
+            self.active -= 1
+            self.inflight_bytes -= size
+            self._cond.notify_all()
+
+    async def send(self, bot, chat_id: int, fs_path: Path, on_wait=None, filename: str | None = None,
+                   caption: str | None = None):
+        size = fs_path.stat().st_size
+        await self.acquire(size, on_wait)
+        started = time.monotonic()
         try:
-            for f in d.iterdir():
-                if not f.is_file():
-                    continue
-                if f.suffix.lower() not in ALLOWED_EXTS:
-                    continue
-                if _norm(f.stem) == target_stem_norm:
-                    return f.resolve()
+            await bot.send_chat_action(chat_id=chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+            with fs_path.open("rb") as f:
+                msg = await bot.send_document(
+                    chat_id=chat_id,
+                    document=InputFile(f, filename=filename or fs_path.name, read_file_handle=False),
+                    caption=caption,
+                )
         except Exception:
+            self.failed += 1
+            raise
+        finally:
+            await self.release(size)
+        elapsed = time.monotonic() - started
+        self.uploads += 1
+        self.bytes_sent += size
+        self.upload_seconds += elapsed
+        METRICS.inc("upload_bytes_total", (), size)
+        METRICS.observe("upload_seconds", (), elapsed)
+        return msg
+
+    def stats(self) -> dict:
+        rate = self.bytes_sent / self.upload_seconds if self.upload_seconds else 0.0
+        return {
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "inflight_mb": round(self.inflight_bytes / 1048576, 1),
+            "uploads": self.uploads,
+            "failed": self.failed,
+            "mb_sent": round(self.bytes_sent / 1048576, 1),
+            "mb_per_s": round(rate / 1048576, 2),
+            "wait_seconds": round(self.wait_seconds, 2),
+        }
+
+UPLOADS = UploadPipeline()
+
+# ===================== بيانات الملفات (الحجم، الصفحات، العنوان، المؤلف) =====================
+# مفهرس في الخلفية يقرأ من كل ملف PDF عدد صفحاته وعنوانه ومؤلفه (من قاموس Info المشار إليه في
+# الـ trailer) داخل ProcessPoolExecutor حتى لا يلمس التحليل حلقة الأحداث. النتائج تُحفظ في SQLite
+# بمفتاح (المسار، mtime)، فلا يُعاد تحليل إلا الملفات الجديدة أو المتغيرة بعد كل إعادة تحميل.
+# تظهر في الأزرار والتعليقات، والملفات الأكبر من حد الرفع يُنبَّه المستخدم لها بدل محاولة رفعها.
+# مع BOT_WORKERS>1 يحلل العامل 0 وحده، والبقية يقرؤون ما كتبه في META_DB.
+META_DB = os.getenv("META_DB") or str(BASE_DIR / "assets" / "meta.sqlite3")
+META_WORKERS = int(os.getenv("META_WORKERS", "1"))  # 0 = معطّل
+META_BATCH = 16
+META_RETRY_SECONDS = 15  # العمّال الذين لا يحللون يعيدون قراءة META_DB حتى تكتمل
+PDF_SCAN_LIMIT = 32 << 20  # أقصى ما نفك ضغطه من object streams لكل ملف
+
+_PDF_INFO_REF = re.compile(rb"/Info\s+(\d+)\s+(\d+)\s+R")
+_PDF_PAGES_DICT = re.compile(rb"<<(?:(?!<<|>>).)*?/Type\s*/Pages\b(?:(?!<<|>>).)*?>>", re.S)
+_PDF_PAGE = re.compile(rb"/Type\s*/Page\b")
+_PDF_COUNT = re.compile(rb"/Count\s+(\d+)")
+_PDF_OBJSTM = re.compile(rb"/Type\s*/ObjStm\b")
+_PDF_ESCAPES = {ord("n"): 10, ord("r"): 13, ord("t"): 9, ord("b"): 8, ord("f"): 12}
+
+def _pdf_string(buf: bytes, i: int) -> bytes | None:
+    # سلسلة PDF حرفية (...) أو ست عشرية <...> تبدأ عند i
+    if buf[i:i + 1] == b"<":
+        j = buf.find(b">", i)
+        if j < 0:
+            return None
+        digits = re.sub(rb"\s", b"", buf[i + 1:j])
+        try:
+            return bytes.fromhex((digits + b"0" * (len(digits) % 2)).decode("ascii"))
+        except ValueError:
+            return None
+    out, depth, j = bytearray(), 0, i
+    while j < len(buf):
+        c = buf[j]
+        if c == 0x5C:  # \
+            j += 1
+            n = buf[j] if j < len(buf) else 0
+            if 0x30 <= n <= 0x37:
+                k = j
+                while k < j + 3 and k < len(buf) and 0x30 <= buf[k] <= 0x37:
+                    k += 1
+                out.append(int(buf[j:k], 8) & 0xFF)
+                j = k
+                continue
+            if n not in (10, 13):
+                out.append(_PDF_ESCAPES.get(n, n))
+        elif c == 0x28:  # (
+            depth += 1
+            if depth > 1:
+                out.append(c)
+        elif c == 0x29:  # )
+            depth -= 1
+            if depth == 0:
+                return bytes(out)
+            out.append(c)
+        else:
+            out.append(c)
+        j += 1
+    return None
+
+def _pdf_text(raw: bytes | None) -> str | None:
+    if not raw:
+        return None
+    if raw[:2] in (b"\xfe\xff", b"\xff\xfe"):
+        text = raw.decode("utf-16", "ignore")
+    else:
+        try:
+            text = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            # PDFDocEncoding قريب من latin-1، لكن كثيرًا من الملفات العربية القديمة تكتب cp1256
+            text = raw.decode("cp1256", "replace") if max(raw) >= 0xC0 else raw.decode("latin-1")
+    text = " ".join(text.replace("\x00", "").split())
+    return text[:200] or None
+
+def _pdf_field(body: bytes, name: bytes) -> str | None:
+    m = re.search(rb"/" + name + rb"\s*([(<])", body)
+    return _pdf_text(_pdf_string(body, m.start(1))) if m else None
+
+def _pdf_object_streams(buf) -> dict[int, bytes]:
+    # الكائنات المضغوطة داخل /ObjStm (PDF 1.5+): رقم الكائن -> نصه
+    objects, budget = {}, PDF_SCAN_LIMIT
+    for m in _PDF_OBJSTM.finditer(buf):
+        head_start = buf.rfind(b"<<", max(0, m.start() - 1024), m.start())
+        start = buf.find(b"stream", m.end(), m.end() + 1024)
+        if head_start < 0 or start < 0:
+            continue
+        head = buf[head_start:start]
+        first = re.search(rb"/First\s+(\d+)", head)
+        start += 6
+        start += 2 if buf[start:start + 2] == b"\r\n" else 1
+        end = buf.find(b"endstream", start)
+        if not first or end < 0 or b"/FlateDecode" not in head:
             continue
+        try:
+            data = zlib.decompressobj().decompress(buf[start:end], budget)
+        except zlib.error:
+            continue
+        budget -= len(data)
+        first = int(first.group(1))
+        nums = [int(x) for x in data[:first].split()]
+        offsets = [(nums[k], first + nums[k + 1]) for k in range(0, len(nums) - 1, 2)]
+        for k, (num, off) in enumerate(offsets):
+            nxt = offsets[k + 1][1] if k + 1 < len(offsets) else len(data)
+            objects[num] = data[off:nxt]
+        if budget <= 0:
+            break
+    return objects
+
+def read_pdf_meta(path: str) -> dict:
+    # تعمل في عملية منفصلة: لا تعتمد إلا على المكتبة القياسية، والملف يُقرأ عبر mmap
+    out = {"size": os.stat(path).st_size, "pages": None, "title": None, "author": None}
+    if not path.lower().endswith(".pdf") or not out["size"]:
+        return out
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        objects = _pdf_object_streams(buf)
+        chunks = [buf, *objects.values()]
+        counts = [int(c.group(1)) for chunk in chunks for d in _PDF_PAGES_DICT.finditer(chunk)
+                  for c in _PDF_COUNT.finditer(d.group(0))]
+        out["pages"] = max(counts) if counts else (
+            sum(len(_PDF_PAGE.findall(chunk)) for chunk in chunks) or None)
+
+        tail = buf[max(0, len(buf) - 65536):]
+        if b"/Encrypt" in tail:
+            return out
+        ref = _PDF_INFO_REF.search(tail) or _PDF_INFO_REF.search(buf[:65536])
+        if not ref:
+            return out
+        num, gen = int(ref.group(1)), int(ref.group(2))
+        body = objects.get(num)
+        if body is None:
+            m = re.search(rb"(?<!\d)%d\s+%d\s+obj\b(.*?)endobj" % (num, gen), buf, re.S)
+            body = m.group(1) if m else b""
+        out["title"] = _pdf_field(body, b"Title")
+        out["author"] = _pdf_field(body, b"Author")
+    return out
+
+def fmt_size(n: int) -> str:
+    if n >= 1 << 20:
+        return f"{n / 1048576:.1f}MB"
+    return f"{max(1, round(n / 1024))}KB"
+
+class AssetMeta:
+    __slots__ = ("mtime_ns", "size", "pages", "title", "author")
+
+    def __init__(self, mtime_ns: int, size: int, pages: int | None, title: str | None, author: str | None):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.pages = pages
+        self.title = title
+        self.author = author
+
+class AssetMetaCache:
+    def __init__(self, db_path: str):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS asset_meta ("
+            " path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER,"
+            " pages INTEGER, title TEXT, author TEXT)"
+        )
+        self._db.commit()
+        self._mem: dict[str, AssetMeta] = {
+            row[0]: AssetMeta(*row[1:])
+            for row in self._db.execute("SELECT path, mtime_ns, size, pages, title, author FROM asset_meta")
+        }
+
+    def __len__(self) -> int:
+        return len(self._mem)
+
+    def peek(self, path: Path) -> AssetMeta | None:
+        return self._mem.get(_rel(path))
+
+    def fresh(self, path: Path, mtime_ns: int) -> bool:
+        meta = self._mem.get(_rel(path))
+        return meta is not None and meta.mtime_ns == mtime_ns
+
+    def put_many(self, rows: list[tuple]):
+        # rows: (path, mtime_ns, size, pages, title, author)؛ تُستدعى من خيط
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO asset_meta VALUES (?, ?, ?, ?, ?, ?)", rows)
+        for row in rows:
+            self._mem[row[0]] = AssetMeta(*row[1:])
+
+    def load(self, paths: list[str]):
+        # يقرأ من القاعدة المشتركة ما كتبته عملية أخرى بعد بدء هذه؛ تُستدعى من خيط
+        with self._lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                rows = self._db.execute(
+                    "SELECT path, mtime_ns, size, pages, title, author FROM asset_meta"
+                    f" WHERE path IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for row in rows:
+                    self._mem[row[0]] = AssetMeta(*row[1:])
+
+class MetaIndexer:
+    def __init__(self, cache: AssetMetaCache, workers: int = META_WORKERS):
+        self.cache = cache
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+        self._wake = asyncio.Event()
+        self.indexed = 0
+        self.failed = 0
+        self.waiting = 0  # ملفات ننتظر أن يحللها العامل المسؤول
+
+    def kick(self):
+        self._wake.set()
+
+    @staticmethod
+    def parses() -> bool:
+        # مع BOT_WORKERS>1 يحلل العامل 0 وحده، والبقية يقرؤون نتائجه من META_DB
+        return BOT_MODE != "worker" or WORKER_INDEX == 0
+
+    async def run(self):
+        while True:
+            if self.waiting:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), META_RETRY_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self._wake.wait()
+            self._wake.clear()
+            try:
+                await self.refresh(CATALOG)
+            except Exception as e:
+                log.warning("Metadata indexing failed: %s", e)
+
+    def _stale(self, cat: CatalogSnapshot) -> list[tuple[str, Path, int]]:
+        todo, seen = [], set()
+        for fid, path in cat.assets.items():
+            if path is None or path in seen:
+                continue
+            seen.add(path)
+            try:
+                mtime_ns = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            if not self.cache.fresh(path, mtime_ns):
+                todo.append((fid, path, mtime_ns))
+        return todo
+
+    async def refresh(self, cat: CatalogSnapshot):
+        todo = await asyncio.to_thread(self._stale, cat)
+        if not todo:
+            self.waiting = 0
+            return
+        # عملية أخرى تشارك META_DB قد تكون حللتها
+        await asyncio.to_thread(self.cache.load, [_rel(path) for _, path, _ in todo])
+        changed = {fid for fid, path, mtime_ns in todo if self.cache.fresh(path, mtime_ns)}
+        todo = [t for t in todo if t[0] not in changed]
+        self.waiting = 0 if self.parses() else len(todo)
+        if todo and self.parses():
+            await self._parse(todo)
+            changed.update(fid for fid, _, _ in todo)
+        if not changed:
+            return
+        # الأزرار تعرض الحجم والصفحات: نعيد بناء أقسام الملفات التي تغيرت
+        sections = {s for s, items in cat.items() if any(f["id"] in changed for f in iter_files(items))}
+        if cat is CATALOG:
+            invalidate_kb(sections)
+            await warm_keyboards(sections)
+
+    async def _parse(self, todo: list[tuple[str, Path, int]]):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers)
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        for i in range(0, len(todo), META_BATCH):
+            batch = todo[i:i + META_BATCH]
+            results = await asyncio.gather(
+                *(loop.run_in_executor(self._pool, read_pdf_meta, str(path)) for _, path, _ in batch),
+                return_exceptions=True,
+            )
+            rows = []
+            for (fid, path, mtime_ns), res in zip(batch, results):
+                if isinstance(res, Exception):
+                    # نحفظ الحجم فقط حتى لا نعيد المحاولة قبل أن يتغير الملف
+                    log.warning("Metadata failed for %s: %s", _rel(path), res)
+                    self.failed += 1
+                    res = {"size": path.stat().st_size, "pages": None, "title": None, "author": None}
+                rows.append((_rel(path), mtime_ns, res["size"], res["pages"], res["title"], res["author"]))
+            await asyncio.to_thread(self.cache.put_many, rows)
+            self.indexed += len(rows)
+        log.info("🧾 Metadata indexed: %d files in %.1fs", len(todo), time.monotonic() - started)
+
+    def close(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+ASSET_META = AssetMetaCache(META_DB)
+META = MetaIndexer(ASSET_META)
+
+def file_badge(itm: Mapping, lang: str, cat: CatalogSnapshot) -> str:
+    # " · 12.3MB · 240 ص" لأزرار الملفات، مع ⚠️ لما يتجاوز حد الرفع
+    path = cat.assets.get(itm["id"])
+    meta = ASSET_META.peek(path) if path else None
+    if not meta:
+        return ""
+    parts = [fmt_size(meta.size)]
+    if meta.pages:
+        parts.append(f"{meta.pages} {L[lang]['pages_short']}")
+    badge = " · " + " · ".join(parts)
+    return badge + " ⚠️" if meta.size > BOT_UPLOAD_LIMIT else badge
+
+def file_caption(item: Mapping, fs_path: Path, lang: str) -> str | None:
+    meta = ASSET_META.peek(fs_path)
+    if not meta:
+        return None
+    lines = [f"📘 {item.get('title') or meta.title or fs_path.stem}"]
+    if meta.author:
+        lines.append(f"✍️ {meta.author}")
+    info = [fmt_size(meta.size)]
+    if meta.pages:
+        info.insert(0, f"{meta.pages} {L[lang]['pages_short']}")
+    lines.append("📄 " + " · ".join(info))
+    return "\n".join(lines)[:1024]
 
-    try:
-        for f in (BASE_DIR / "assets").rglob("*"):
-            if f.is_file() and f.suffix.lower() in ALLOWED_EXTS:
-                if _norm(f.stem) == target_stem_norm:
-                    return f.resolve()
-    except Exception:
-        pass
+# ===================== إرسال الملفات =====================
+async def upload_document(update: Update, context: ContextTypes.DEFAULT_TYPE, fs_path: Path,
+                          filename: str | None = None, notice=None, caption: str | None = None):
+    # رفع عبر خط الرفع؛ رسالة "جارٍ التحضير" تظهر إن انتظر الملف دوره وتُحذف بعد الإرسال
+    chat_id = update.effective_chat.id
 
-    return None
+    async def on_wait():
+        nonlocal notice
+        if notice is None:
+            notice = await context.bot.send_message(chat_id, L[ulang(update)]["preparing"])
 
-# ===================== إرسال الملفات =====================
-async def send_book(update: Update, context: ContextTypes.DEFAULT_TYPE, rel_path: str):
-    fs_path = resolve_relaxed(rel_path)
+    try:
+        return await UPLOADS.send(context.bot, chat_id, fs_path, on_wait, filename, caption)
+    finally:
+        if notice:
+            try:
+                await notice.delete()
+            except Exception:
+                pass
+
+async def send_book(update: Update, context: ContextTypes.DEFAULT_TYPE, item_id: str):
+    # نسخة الكتالوج التي بدأ بها الطلب، حتى لو استُبدلت أثناء الرفع
+    cat = CATALOG
+    item = cat.find_file(item_id)
+    if not item:
+        log.warning("Unknown catalog item: %s", item_id)
+        await update.effective_message.reply_text(L[ulang(update)]["missing"] + item_id)
+        return
+    rel_path = item["path"]
+    fs_path = cat.assets.get(item["id"]) or resolve_relaxed(rel_path)
     if not fs_path:
         log.warning("Missing file (relaxed not found): %s", rel_path)
         await update.effective_message.reply_text(L[ulang(update)]["missing"] + rel_path)
@@ -314,22 +1830,253 @@ async def send_book(update: Update, context: ContextTypes.DEFAULT_TYPE, rel_path
         await update.effective_message.reply_text(L[ulang(update)]["missing"] + rel_path)
         return
 
+    chat_id = update.effective_chat.id
+    lang = ulang(update)
+    caption = file_caption(item, fs_path, lang)
     try:
-        with fs_path.open("rb") as f:
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=InputFile(f, filename=fs_path.name),
-            )
+        file_id = await FILE_IDS.get(fs_path)
+        if file_id:
+            try:
+                await context.bot.send_document(chat_id=chat_id, document=file_id, caption=caption)
+                return
+            except BadRequest as e:
+                # file_id لم يعد صالحًا: نحذفه ونرفع الملف من جديد
+                log.warning("Stale file_id for %s: %s", fs_path, e)
+                await FILE_IDS.drop(fs_path)
+        size = fs_path.stat().st_size
+        if size > BOT_UPLOAD_LIMIT:
+            # تيليجرام سيرفضه بعد أن نكون قد أرسلنا الملف كله: نعتذر مباشرة
+            METRICS.inc("uploads_refused_total", ())
+            await update.effective_message.reply_text(L[lang]["too_big"].format(size=fmt_size(size)))
+            return
+        msg = await upload_document(update, context, fs_path, caption=caption)
     except Exception as e:
         log.error("Failed to send %s: %s", fs_path, e, exc_info=True)
         await update.effective_message.reply_text(L[ulang(update)]["missing"] + rel_path)
+        return
+    if msg.document:
+        try:
+            await FILE_IDS.put(fs_path, msg.document.file_id, cat.sha256(item["id"], fs_path))
+        except Exception as e:
+            # الملف وصل للمستخدم؛ كل ما نخسره أن الطلب القادم يرفعه من جديد
+            log.warning("Failed to cache file_id for %s: %s", fs_path, e)
+
+# ===================== حزم السلاسل (ZIP) =====================
+# "تحميل السلسلة كاملة" يرسل ملف ZIP واحدًا بكل أجزاء السلسلة الموجودة. الحزمة تُكتب في خيط
+# منفصل بالبث من القرص (بلا ضغط: ملفات PDF مضغوطة أصلًا)، واسمها بصمة محتوى أجزائها، فتُرفع
+# مرة واحدة ويُعاد استخدام file_id لها ما دام المحتوى نفسه. الحزم على القرص تُحذف الأقدم
+# استخدامًا أولًا متى تجاوز مجموعها BUNDLE_BUDGET_MB.
+BUNDLE_DIR = Path(os.getenv("BUNDLE_DIR") or BASE_DIR / ".cache" / "bundles")
+BUNDLE_BUDGET_MB = float(os.getenv("BUNDLE_BUDGET_MB", "500"))
+
+_CONTENT_HASHES: dict[tuple[str, int, int], str] = {}  # (المسار، الحجم، mtime_ns) -> sha256
+
+async def content_sha256(cat: CatalogSnapshot, fid: str, path: Path) -> str:
+    sha = cat.sha256(fid, path)
+    if sha:
+        return sha
+    st = path.stat()
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    sha = _CONTENT_HASHES.get(key)
+    if sha is None:
+        sha = _CONTENT_HASHES[key] = await asyncio.to_thread(_file_sha256, path)
+    return sha
+
+class BundleCache:
+    def __init__(self, root: Path, budget_bytes: int):
+        self.root = root
+        self.budget = budget_bytes
+        self._building: dict[str, asyncio.Future] = {}
+        self.built = 0
+        self.hits = 0
+        self.evicted = 0
+
+    async def members(self, cat: CatalogSnapshot, series: Mapping) -> tuple[str, list[tuple[Path, str]]]:
+        # (البصمة، [(الملف، الاسم داخل الحزمة)]) للأجزاء الموجودة على القرص فقط
+        members, parts, names = [], [], set()
+        for child in series["children"]:
+            path = cat.assets.get(child["id"])
+            if not path:
+                continue
+            arcname = path.name
+            n = 1
+            while arcname in names:
+                n += 1
+                arcname = f"{path.stem}_{n}{path.suffix}"
+            names.add(arcname)
+            members.append((path, arcname))
+            parts.append(f"{arcname}:{await content_sha256(cat, child['id'], path)}")
+        digest = hashlib.blake2b("\n".join(parts).encode("utf-8"), digest_size=12).hexdigest()
+        return digest, members
+
+    async def path(self, digest: str, members: list[tuple[Path, str]]) -> Path:
+        dest = self.root / f"{digest}.zip"
+        fut = self._building.get(digest)
+        if fut is None:
+            if await asyncio.to_thread(self._touch, dest):
+                self.hits += 1
+                return dest
+            fut = asyncio.ensure_future(asyncio.to_thread(self._build, dest, members))
+            self._building[digest] = fut
+            fut.add_done_callback(lambda _: self._building.pop(digest, None))
+        return await asyncio.shield(fut)
+
+    @staticmethod
+    def _touch(dest: Path) -> bool:
+        # mtime = آخر استخدام، ومنه يُحسب ترتيب الحذف
+        try:
+            os.utime(dest)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _build(self, dest: Path, members: list[tuple[Path, str]]) -> Path:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f"{dest.stem}.{os.getpid()}.tmp")
+        try:
+            with zipfile.ZipFile(tmp, "w", zipfile.ZIP_STORED, allowZip64=True) as zf:
+                for path, arcname in members:
+                    zf.write(path, arcname)  # ينسخ على أجزاء، لا يحمّل الملف كاملًا
+            os.replace(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+        self.built += 1
+        self._evict(dest)
+        return dest
+
+    def _evict(self, keep: Path):
+        entries = []
+        for p in self.root.glob("*.zip"):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.budget:
+                break
+            if p == keep:
+                continue
+            p.unlink(missing_ok=True)
+            total -= size
+            self.evicted += 1
+
+    def disk_bytes(self) -> int:
+        return sum(p.stat().st_size for p in self.root.glob("*.zip")) if self.root.exists() else 0
+
+BUNDLES = BundleCache(BUNDLE_DIR, int(BUNDLE_BUDGET_MB * 1024 * 1024))
+
+async def send_bundle(update: Update, context: ContextTypes.DEFAULT_TYPE, cat: CatalogSnapshot,
+                      section: str, series: Mapping):
+    lang = ulang(update)
+    chat_id = update.effective_chat.id
+    try:
+        digest, members = await BUNDLES.members(cat, series)
+        if not members:
+            await update.effective_message.reply_text(L[lang]["missing"] + series["title"])
+            return
+        key = f"bundle:{digest}"
+        file_id = await FILE_IDS.get_key(key)
+        if file_id:
+            try:
+                await context.bot.send_document(chat_id=chat_id, document=file_id)
+                METRICS.inc("bundles_total", (("result", "file_id"),))
+                return
+            except BadRequest as e:
+                log.warning("Stale file_id for bundle %s: %s", digest, e)
+                await FILE_IDS.drop_key(key)
+        if sum(p.stat().st_size for p, _ in members) > BOT_UPLOAD_LIMIT:
+            # الحزمة بلا ضغط: مجموع الأجزاء يكفي لرفضها قبل بنائها
+            await update.effective_message.reply_text(L[lang]["bundle_too_big"])
+            METRICS.inc("bundles_total", (("result", "too_big"),))
+            return
+        notice = None
+        if not BUNDLES.root.joinpath(f"{digest}.zip").exists():
+            # البناء يأخذ وقتًا: نُعلم المستخدم قبل أن يبدأ
+            notice = await context.bot.send_message(chat_id, L[lang]["preparing"])
+        try:
+            path = await BUNDLES.path(digest, members)
+            size = path.stat().st_size
+            if size > BOT_UPLOAD_LIMIT:
+                await update.effective_message.reply_text(L[lang]["bundle_too_big"])
+                METRICS.inc("bundles_total", (("result", "too_big"),))
+                return
+            # من هنا upload_document هي التي تحذف رسالة التحضير
+            pending, notice = notice, None
+            msg = await upload_document(update, context, path, f"{series['title']}.zip", pending)
+        finally:
+            if notice:
+                try:
+                    await notice.delete()
+                except Exception:
+                    pass
+        METRICS.inc("bundles_total", (("result", "uploaded"),))
+    except Exception as e:
+        log.error("Failed to send bundle for %s/%s: %s", section, series["title"], e, exc_info=True)
+        await update.effective_message.reply_text(L[lang]["missing"] + series["title"])
+        return
+    if msg.document:
+        try:
+            await FILE_IDS.put_key(key, msg.document.file_id, size, digest)
+        except Exception as e:
+            log.warning("Failed to cache file_id for bundle %s: %s", digest, e)
 
 # ===================== رسالة القائمة القابلة للتعديل =====================
+# نحفظ بصمة آخر (نص، لوحة) أُرسل لرسالة القائمة فلا نرسل تعديلًا مطابقًا لما يعرضه المستخدم.
+# والنقرات المتتالية السريعة تُدمج: نقرة تنقّل تلتها نقرة تنقّل أحدث من المستخدم نفسه (ما زالت
+# في الطابور) لا تُرسم، فلا يصل إلا آخر شاشة. MENU_DEBOUNCE_MS يمهل النقرة قليلًا قبل رسمها.
+# مع BOT_WORKERS>1 يحدث الدمج والمهلة في مسارات الموزّع (WorkerProcess.put/deliver) لا هنا.
+MENU_DEBOUNCE = float(os.getenv("MENU_DEBOUNCE_MS", "0")) / 1000
+COALESCE_KINDS = {"cat", "back", "series"}  # نقرات لا تفعل إلا إعادة رسم القائمة
+
+class TapCoalescer:
+    def __init__(self):
+        self._latest: dict[int, int] = {}  # uid -> update_id آخر نقرة تنقّل وصلت
+
+    @staticmethod
+    def _nav_user(update: object) -> int | None:
+        if isinstance(update, Update) and update.callback_query and update.effective_user:
+            if (update.callback_query.data or "").partition("|")[0] in COALESCE_KINDS:
+                return update.effective_user.id
+        return None
+
+    def arrived(self, update: object):
+        # يُستدعى عند وصول التحديث، قبل انتظار دور المستخدم
+        uid = self._nav_user(update)
+        if uid is not None:
+            self._latest[uid] = max(self._latest.get(uid, 0), update.update_id)
+
+    def superseded(self, update: Update) -> bool:
+        latest = self._latest.get(update.effective_user.id)
+        return latest is not None and latest > update.update_id
+
+    def done(self, update: Update):
+        uid = update.effective_user.id
+        latest = self._latest.get(uid)
+        if latest is not None and latest == update.update_id:
+            del self._latest[uid]
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+TAPS = TapCoalescer()
+
 async def set_menu_message(user_id: int, chat_id: int, message_id: int):
-    MENU_MSG[user_id] = (chat_id, message_id)
+    if USERS.get(user_id).menu != (chat_id, message_id):
+        USERS.update(user_id, menu=(chat_id, message_id))
+
+def _mark_rendered(user_id: int, chat_id: int, message_id: int, digest: int):
+    USERS.get(user_id).rendered = (chat_id, message_id, digest)
+
+async def _menu_reply(update: Update, text: str, kb: InlineKeyboardMarkup, digest: int):
+    uid = update.effective_user.id
+    msg = await update.effective_message.reply_text(text, reply_markup=kb)
+    await set_menu_message(uid, msg.chat.id, msg.message_id)
+    _mark_rendered(uid, msg.chat.id, msg.message_id, digest)
 
 def get_menu_message(user_id: int):
-    return MENU_MSG.get(user_id)
+    return USERS.get(user_id).menu
 
 async def ensure_menu_exists(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -343,12 +2090,16 @@ async def ensure_menu_exists(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def menu_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, kb: InlineKeyboardMarkup):
     uid = update.effective_user.id
+    digest = hash((text, kb))
     pair = get_menu_message(uid)
     if not pair:
-        msg = await update.effective_message.reply_text(text, reply_markup=kb)
-        await set_menu_message(uid, msg.chat.id, msg.message_id)
+        METRICS.inc("menu_edits_total", (("result", "new"),))
+        await _menu_reply(update, text, kb, digest)
         return
     chat_id, msg_id = pair
+    if USERS.get(uid).rendered == (chat_id, msg_id, digest):
+        METRICS.inc("menu_edits_total", (("result", "unchanged"),))
+        return
     try:
         await context.bot.edit_message_text(
             chat_id=chat_id,
@@ -356,39 +2107,50 @@ async def menu_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, text: st
             text=text,
             reply_markup=kb,
         )
+        METRICS.inc("menu_edits_total", (("result", "edited"),))
+        _mark_rendered(uid, chat_id, msg_id, digest)
+    except RetryAfter as e:
+        # المجدول استنفد محاولاته؛ رسالة جديدة ستزيد الضغط فقط
+        log.warning("Menu edit dropped for %s: %s", uid, e)
     except BadRequest as e:
         if "message is not modified" in str(e).lower():
+            _mark_rendered(uid, chat_id, msg_id, digest)
             return
-        msg = await update.effective_message.reply_text(text, reply_markup=kb)
-        await set_menu_message(uid, msg.chat.id, msg.message_id)
+        await _menu_reply(update, text, kb, digest)
     except Exception:
-        msg = await update.effective_message.reply_text(text, reply_markup=kb)
-        await set_menu_message(uid, msg.chat.id, msg.message_id)
+        await _menu_reply(update, text, kb, digest)
 
 # ===================== شاشة الترحيب + الدخول =====================
-def landing_kb(update: Update) -> InlineKeyboardMarkup:
-    rows = [[InlineKeyboardButton(L[ulang(update)]["start"], callback_data="go|start")]]
+def _landing_kb(lang: str) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(L[lang]["start"], callback_data="go|start")]]
     rows.append([
         InlineKeyboardButton("🇸🇦 عربي", callback_data="lang|ar"),
         InlineKeyboardButton("🇬🇧 English", callback_data="lang|en"),
     ])
-    btn = contact_inline_button(update)
+    btn = _contact_button(lang)
     if btn:
         rows.append([btn])
     return InlineKeyboardMarkup(rows)
 
+def landing_kb(update: Update) -> InlineKeyboardMarkup:
+    lang = ulang(update)
+    return cached_kb(("landing", lang), lambda: _landing_kb(lang))
+
+@timed("landing")
 async def landing(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    USER_LANG.setdefault(uid, USER_LANG.get(uid, "ar"))
+    # رابط عميق من نتائج البحث المضمّن: /start f_<id>
+    if context.args and context.args[0].startswith("f_"):
+        if await ensure_membership(update, context):
+            await send_book(update, context, context.args[0][2:])
+        return
     await update.effective_message.reply_text(L[ulang(update)]["intro"], reply_markup=landing_kb(update))
 
 async def enter_app(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    USER_LANG.setdefault(uid, USER_LANG.get(uid, "ar"))
     if not await ensure_membership(update, context):
         return
-    if uid not in KB_SENT:
-        KB_SENT.add(uid)
+    if not USERS.get(uid).kb_sent:
+        USERS.update(uid, kb_sent=True)
         await update.effective_message.reply_text(
             t(update, "welcome"),
             reply_markup=bottom_keyboard(update),
@@ -397,20 +2159,159 @@ async def enter_app(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
 
 # ===================== أوامر ومعالجات =====================
+@timed("cmd_reload")
 async def cmd_reload(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global CATALOG
     try:
-        CATALOG = load_catalog()
-        await update.effective_message.reply_text("✅ تم إعادة تحميل الكاتالوج.")
-        await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+        diff = await reload_catalog()
     except Exception as e:
         await update.effective_message.reply_text(f"❌ خطأ في إعادة التحميل: {e}")
+        return
+    lines = [
+        "✅ تم إعادة تحميل الكاتالوج.",
+        f"➕ {len(diff['added'])}  ➖ {len(diff['removed'])}  ✏️ {len(diff['changed'])}",
+    ]
+    if CATALOG.missing:
+        lines.append(f"⚠️ ملفات غير موجودة على السيرفر: {len(CATALOG.missing)}")
+    await update.effective_message.reply_text("\n".join(lines))
+    await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+
+# ===================== جداول التوجيه =====================
+# كل مسار يعلن معالجه وهل يحتاج التحقق من الاشتراك. جدول الأزرار النصية يُجمَّع مرة لكل نسخة
+# كتالوج من تسميات كل اللغات في L، فيكون التوجيه بحثًا واحدًا في قاموس مهما زادت اللغات.
+# زمن كل مسار (مع تحقق الاشتراك) يُسجَّل في route_seconds{router, route}.
+class Route:
+    __slots__ = ("name", "handler", "member")
+
+    def __init__(self, name: str, handler, member: bool = False):
+        self.name = name
+        self.handler = handler  # async handler(update, context, arg)
+        self.member = member
+
+class Router:
+    def __init__(self, name: str, fallback: Route | None = None):
+        self.name = name
+        self.table: dict[str, tuple[Route, str]] = {}
+        self.fallback = fallback  # يستقبل المفتاح نفسه معاملًا
+
+    def add(self, key: str, route: Route, arg: str = ""):
+        self.table.setdefault(key, (route, arg))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.table
+
+    async def dispatch(self, key: str, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                       arg: str | None = None) -> bool:
+        hit = self.table.get(key)
+        if hit is None:
+            if self.fallback is None:
+                return False
+            hit = (self.fallback, key)
+        route, fixed = hit
+        started = time.perf_counter()
+        try:
+            if route.member and not await ensure_membership(update, context):
+                return True
+            await route.handler(update, context, fixed if arg is None else arg)
+        finally:
+            METRICS.observe("route_seconds", (("router", self.name), ("route", route.name)),
+                            time.perf_counter() - started)
+        return True
+
+# ----- مسارات الأزرار المضمّنة (callback_data = kind|arg) -----
+async def cb_go(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await enter_app(update, context)
+
+async def cb_verify(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    MEMBERSHIP.invalidate(update.effective_user.id)
+    await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+    await update.effective_message.reply_text(
+        L[ulang(update)]["joined"], reply_markup=bottom_keyboard(update)
+    )
+
+async def cb_lang(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    USERS.update(update.effective_user.id, lang="ar" if arg == "ar" else "en")
+    # إذا كنا ما زلنا في شاشة الترحيب
+    await menu_edit(update, context, L[ulang(update)]["intro"], landing_kb(update))
+
+async def cb_back(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    if arg == "main":
+        await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+
+def _page_arg(arg: str) -> tuple[str, int]:
+    arg, _, page = arg.partition("|")
+    return arg, int(page) if page.isdigit() else 0
+
+async def cb_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    section, page = _page_arg(arg)
+    cat = CATALOG
+    if section not in cat:
+        # callback_data من المستخدم: قسم غير موجود لا يدخل مفتاح كاش اللوحات
+        await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+        return
+    await menu_edit(update, context, section_label(update, section),
+                    build_section_kb(section, update, page, cat))
+
+async def cb_series(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    token, page = _page_arg(arg)
+    cat = CATALOG
+    hit = cat.find_series(token)
+    if not hit:
+        await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+        return
+    section, series = hit
+    await menu_edit(update, context, section_label(update, section),
+                    build_series_kb(section, series, update, page, cat))
+
+async def cb_file(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await send_book(update, context, arg)
 
+async def cb_zip(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    cat = CATALOG
+    hit = cat.find_series(arg)
+    if not hit:
+        await menu_edit(update, context, t(update, "welcome"), main_menu_inline(update))
+        return
+    await send_bundle(update, context, cat, *hit)
+
+CALLBACKS = Router("callback")
+for _route in (
+    Route("go", cb_go),
+    Route("verify", cb_verify),
+    Route("lang", cb_lang),
+    Route("back", cb_back, member=True),
+    Route("cat", cb_cat, member=True),
+    Route("series", cb_series, member=True),
+    Route("file", cb_file, member=True),
+    Route("zip", cb_zip, member=True),
+):
+    CALLBACKS.add(_route.name, _route)
+
+def callback_kind(update: Update) -> str:
+    kind = (update.callback_query.data or "").partition("|")[0]
+    return kind if kind in CALLBACKS or kind == "noop" else "other"
+
+@timed("on_callback", label=callback_kind)
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
-    data = (q.data or "")
-    kind, _, rest = data.partition("|")
+    try:
+        await q.answer()
+    except TelegramError as e:
+        # الرد على النقرة تجميلي فقط: فشله لا يمنع تنفيذها
+        log.warning("answerCallbackQuery failed: %s", e)
+    kind, _, rest = (q.data or "").partition("|")
+    if kind == "noop":
+        return
+    if kind in COALESCE_KINDS:
+        if TAPS.superseded(update):
+            # نقرة أحدث من المستخدم نفسه في الطابور سترسم الشاشة النهائية
+            METRICS.inc("menu_edits_total", (("result", "coalesced"),))
+            return
+        if MENU_DEBOUNCE:
+            await asyncio.sleep(MENU_DEBOUNCE)
+            if TAPS.superseded(update):
+                METRICS.inc("menu_edits_total", (("result", "coalesced"),))
+                return
+        TAPS.done(update)
 
     # حفظ رسالة القائمة إن كانت هذه هي الرسالة
     try:
@@ -418,117 +2319,840 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         pass
 
-    if kind == "go":
-        await enter_app(update, context); return
+    await CALLBACKS.dispatch(kind, update, context, rest)
 
-    if kind == "verify":
-        await q.edit_message_text(t(update, "welcome"), reply_markup=main_menu_inline(update))
-        await update.effective_message.reply_text(
-            L[ulang(update)]["joined"], reply_markup=bottom_keyboard(update)
-        )
-        return
+# ----- مسارات أزرار اللوحة السفلية (النص = التسمية بأي لغة) -----
+async def txt_start(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await enter_app(update, context)
 
-    if kind == "lang":
-        USER_LANG[update.effective_user.id] = "ar" if rest == "ar" else "en"
-        # إذا كنا ما زلنا في شاشة الترحيب
-        await q.edit_message_text(L[ulang(update)]["intro"], reply_markup=landing_kb(update))
-        return
-
-    if not await ensure_membership(update, context):
-        return
+async def txt_change_language(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    USERS.update(update.effective_user.id, lang=("en" if ulang(update) == "ar" else "ar"))
+    await update.effective_message.reply_text(L[ulang(update)]["intro"], reply_markup=landing_kb(update))
 
-    if kind == "back" and rest == "main":
-        await q.edit_message_text(t(update, "welcome"), reply_markup=main_menu_inline(update))
-        return
+async def txt_contact(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    # تواصل مع الإدارة
+    if OWNER_USERNAME:
+        await update.effective_message.reply_text(
+            f"{L[ulang(update)]['help_text_contact']} https://t.me/{OWNER_USERNAME}",
+            reply_markup=bottom_keyboard(update),
+            disable_web_page_preview=True,
+        )
+    else:
+        await update.effective_message.reply_text(
+            "ضع OWNER_USERNAME في متغيرات البيئة لتمكين رابط التواصل.",
+            reply_markup=bottom_keyboard(update),
+        )
 
-    if kind == "cat":
-        section = rest
-        await q.edit_message_text(section_label(update, section), reply_markup=build_section_kb(section, update))
-        return
+async def txt_myinfo(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    lang = ulang(update)
+    name = (update.effective_user.full_name or "-")
+    user = (update.effective_user.username or "-")
+    msg = L[lang]["info_fmt"].format(name=name, user=user, uid=update.effective_user.id, lang=lang)
+    await update.effective_message.reply_text(msg, reply_markup=bottom_keyboard(update))
 
-    if kind == "series":
-        section = rest
-        await q.edit_message_text(section_label(update, section), reply_markup=build_series_kb(section, update))
-        return
+async def txt_greet(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await update.effective_message.reply_text(L[ulang(update)]["greet_text"], reply_markup=bottom_keyboard(update))
 
-    if kind == "file":
-        await send_book(update, context, rest)
-        return
+async def txt_section(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await menu_edit(update, context, section_label(update, arg), build_section_kb(arg, update))
 
-def label_to_section_map(lang: str) -> dict[str, str]:
-    return {v: k for k, v in L[lang]["sections"].items()}
+async def txt_search(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str):
+    await reply_search(update, arg)
 
+TEXT_BUTTONS = (
+    ("start", Route("start", txt_start)),
+    ("change_language", Route("change_language", txt_change_language)),
+    ("contact_short", Route("contact", txt_contact)),
+    ("myinfo", Route("myinfo", txt_myinfo)),
+    ("greet", Route("greet", txt_greet)),
+)
+SECTION_ROUTE = Route("section", txt_section, member=True)
+# أي نص آخر: بحث في العناوين
+SEARCH_ROUTE = Route("search", txt_search, member=True)
+_TEXT_ROUTER: tuple[int, Router] | None = None
+
+def compile_text_router(cat: CatalogSnapshot) -> Router:
+    router = Router("text", fallback=SEARCH_ROUTE)
+    for lang in L:
+        for key, route in TEXT_BUTTONS:
+            router.add(L[lang][key], route)
+    for lang in L:
+        for section in chain(L[lang]["sections"], cat):
+            router.add(L[lang]["sections"].get(section, section), SECTION_ROUTE, section)
+    return router
+
+def text_router() -> Router:
+    global _TEXT_ROUTER
+    cat = CATALOG
+    if _TEXT_ROUTER is None or _TEXT_ROUTER[0] != cat.version:
+        _TEXT_ROUTER = (cat.version, compile_text_router(cat))
+    return _TEXT_ROUTER[1]
+
+@timed("on_text")
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
-    uid = update.effective_user.id
-    lang = USER_LANG.get(uid, "ar")
-
-    # زر Start من اللوحة السفلية
-    if text == L[lang]["start"]:
-        await enter_app(update, context); return
-
-    # تغيير اللغة
-    if text == L[lang]["change_language"]:
-        USER_LANG[uid] = ("en" if lang == "ar" else "ar")
-        await update.effective_message.reply_text(L[ulang(update)]["intro"], reply_markup=landing_kb(update))
+    if text:
+        await text_router().dispatch(text, update, context)
+
+# ===================== البحث =====================
+async def reply_search(update: Update, query: str):
+    lang = ulang(update)
+    cat = CATALOG
+    ids = cat.search.search(query)
+    if not ids:
+        await update.effective_message.reply_text(L[lang]["search_none"].format(q=query))
         return
-
-    # تواصل مع الإدارة
-    if text == L[lang]["contact_short"]:
-        if OWNER_USERNAME:
-            await update.effective_message.reply_text(
-                f"{L[ulang(update)]['help_text_contact']} https://t.me/{OWNER_USERNAME}",
-                reply_markup=bottom_keyboard(update),
-                disable_web_page_preview=True,
-            )
-        else:
-            await update.effective_message.reply_text(
-                "ضع OWNER_USERNAME في متغيرات البيئة لتمكين رابط التواصل.",
-                reply_markup=bottom_keyboard(update),
-            )
+    rows = [[InlineKeyboardButton(f"📄 {cat.labels[i]}", callback_data=f"file|{i}")] for i in ids]
+    await update.effective_message.reply_text(
+        L[lang]["search_results"].format(q=query), reply_markup=InlineKeyboardMarkup(rows)
+    )
+
+@timed("on_inline_query")
+async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    query = (iq.query or "").strip()
+    if not query:
+        await iq.answer([], cache_time=300)
         return
+    lang = ulang(update)
+    # الملف نفسه لا يُعطى إلا للمشترك؛ غيره يرى روابط /start التي تمر بالتحقق
+    member = True
+    if REQUIRED_CHANNEL:
+        member = await MEMBERSHIP.check(context.bot, iq.from_user.id)
+        if member is None:
+            member = MEMBERSHIP_FAIL_OPEN
+    cat = CATALOG
+    results = []
+    for item_id in cat.search.search(query, limit=20):
+        title = cat.labels[item_id]
+        fs_path = cat.assets.get(item_id)
+        file_id = FILE_IDS.peek(fs_path) if fs_path and member else None
+        if file_id:
+            results.append(InlineQueryResultCachedDocument(item_id, title, file_id))
+        else:
+            # لم يُرفع بعد: زر يفتح البوت ويطلب الملف
+            link = f"https://t.me/{context.bot.username}?start=f_{item_id}"
+            results.append(InlineQueryResultArticle(
+                item_id, title, InputTextMessageContent(f"📄 {title}"),
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(L[lang]["search_open"], url=link)]]),
+            ))
+    # النتائج تختلف حسب الاشتراك: لا يشاركها تيليجرام بين المستخدمين
+    await iq.answer(results, cache_time=60, is_personal=bool(REQUIRED_CHANNEL))
+
+# ===================== معالجة التحديثات بالتوازي =====================
+# تحديثات المستخدمين المختلفين تُعالج بالتوازي حتى UPDATE_CONCURRENCY، وتحديثات
+# المستخدم الواحد تبقى بترتيب وصولها (قفل لكل مستخدم، وأقفال asyncio عادلة FIFO).
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "10000"))
+UPDATE_STATS_SECONDS = float(os.getenv("UPDATE_STATS_SECONDS", "60"))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, max_pending: int = UPDATE_MAX_PENDING):
+        # سيمافور الأساس يحدّ عدد التحديثات المعلّقة فقط؛ حد التوازي الفعلي يُطبَّق
+        # بعد أخذ قفل المستخدم، حتى لا يحجز مستخدم كثير النقر كل المقاعد وهو ينتظر دوره
+        super().__init__(max_pending)
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._user_locks: dict[int, list] = {}  # uid -> [Lock, عدد المنتظرين]
+        self.waiting = 0
+        self.active = 0
+        self.processed = 0
+        self.max_waiting = 0
+        self._waits: deque[float] = deque(maxlen=1024)
+
+    @staticmethod
+    def _key(update: object) -> int | None:
+        if isinstance(update, Update) and update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        queued_at = time.monotonic()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        uid = self._key(update)
+        entry = None
+        if uid is not None:
+            entry = self._user_locks.setdefault(uid, [asyncio.Lock(), 0])
+            entry[1] += 1
+        started = False
+        TAPS.arrived(update)
+        try:
+            if entry:
+                await entry[0].acquire()
+            try:
+                if uid is not None:
+                    await USERS.preload(uid)
+                async with self._slots:
+                    self.waiting -= 1
+                    started = True
+                    self._waits.append(time.monotonic() - queued_at)
+                    self.active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+            finally:
+                if entry:
+                    entry[0].release()
+        finally:
+            if not started:
+                self.waiting -= 1
+            if entry:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._user_locks[uid]
+
+    async def initialize(self) -> None:
+        pass
 
-    # معلوماتي + الترحيب
-    if text == L[lang]["myinfo"]:
-        name = (update.effective_user.full_name or "-")
-        user = (update.effective_user.username or "-")
-        msg = L[lang]["info_fmt"].format(name=name, user=user, uid=update.effective_user.id, lang=lang)
-        await update.effective_message.reply_text(msg, reply_markup=bottom_keyboard(update))
-        return
+    async def shutdown(self) -> None:
+        pass
 
-    if text == L[lang]["greet"]:
-        await update.effective_message.reply_text(L[lang]["greet_text"], reply_markup=bottom_keyboard(update))
-        return
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        pct = lambda q: waits[min(len(waits) - 1, int(q * len(waits)))] * 1000 if waits else 0.0
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_waiting,
+            "processed": self.processed,
+            "wait_ms_p50": round(pct(0.50), 2),
+            "wait_ms_p99": round(pct(0.99), 2),
+        }
+
+UPDATES = PerUserUpdateProcessor()
+
+async def update_stats_logger():
+    while True:
+        await asyncio.sleep(UPDATE_STATS_SECONDS)
+        log.info("📊 Updates: %s | Outbound: %s | Uploads: %s",
+                 UPDATES.stats(), OUTBOUND.stats(), UPLOADS.stats())
+
+# ===================== جدولة الطلبات الصادرة =====================
+# كل طلبات Bot API تمر عبر OutboundScheduler (rate_limiter الخاص بـ PTB): دلو رموز عام
+# (~30 رسالة/ث) ودلو لكل محادثة، تعديلات القوائم قبل إرسال الملفات، وإعادة المحاولة
+# تلقائيًا بعد RetryAfter بدل إرسال رسائل جديدة.
+RATE_GLOBAL = float(os.getenv("RATE_GLOBAL", "30"))          # رسالة/ث لكل البوت
+RATE_PRIVATE_CHAT = float(os.getenv("RATE_PRIVATE_CHAT", "1"))  # رسالة/ث للمحادثة الخاصة
+RATE_GROUP_CHAT = float(os.getenv("RATE_GROUP_CHAT", str(20 / 60)))
+RATE_CHAT_BURST = float(os.getenv("RATE_CHAT_BURST", "3"))
+RATE_MAX_RETRIES = int(os.getenv("RATE_MAX_RETRIES", "3"))
+RATE_CHAT_BUCKETS = 10000
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+BULK_ENDPOINTS = {"sendDocument", "sendChatAction"}
+# طلبات لا تُحتسب ضمن حدود الرسائل
+UNLIMITED_ENDPOINTS = {
+    "answerCallbackQuery", "answerInlineQuery", "getChatMember", "getMe", "getUpdates",
+    "setWebhook", "deleteWebhook", "getWebhookInfo", "getFile", "close", "logOut",
+}
 
-    # خرائط الأقسام (باللغتين)
-    for l in ("ar", "en"):
-        sec_map = label_to_section_map(l)
-        if text in sec_map:
-            # تحقق اشتراك قبل الدخول للأقسام
-            if not await ensure_membership(update, context):
-                return
-            key = sec_map[text]
-            await menu_edit(update, context, section_label(update, key), build_section_kb(key, update))
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []  # heap (priority, seq, fut)
+        self._seq = 0
+        self._pump: asyncio.Task | None = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def idle(self) -> bool:
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst
+
+    def pause(self, seconds: float):
+        # لا رموز قبل مرور seconds
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
             return
+        fut = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    async def _run(self):
+        while self._waiters:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():  # أُلغي المنتظر
+                continue
+            self.tokens -= 1
+            fut.set_result(None)
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self):
+        self.global_bucket = TokenBucket(RATE_GLOBAL, RATE_GLOBAL)
+        self._chats: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self.calls: dict[str, int] = {}
+        self.retry_after = 0
+        self.wait_seconds = 0.0
+
+    async def initialize(self) -> None:
+        pass
 
-# ===================== التشغيل =====================
-def main():
-    if not TOKEN:
-        raise RuntimeError("TELEGRAM_TOKEN is not set")
-    start_health_thread()
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = RATE_GROUP_CHAT if is_group else RATE_PRIVATE_CHAT
+            bucket = self._chats[chat_id] = TokenBucket(rate, RATE_CHAT_BURST)
+            if len(self._chats) > RATE_CHAT_BUCKETS:
+                for key in [k for k, b in self._chats.items() if b.idle()][:len(self._chats) // 2]:
+                    del self._chats[key]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        # الطلبات غير المحدودة لا تمر بالدلاء، لكنها تُعاد بعد RetryAfter مثل غيرها
+        limited = endpoint not in UNLIMITED_ENDPOINTS
+        priority = (rate_limit_args or {}).get("priority")
+        if priority is None:
+            priority = PRIORITY_BULK if endpoint in BULK_ENDPOINTS else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id")
+        attempt = 0
+        while True:
+            if limited:
+                started = time.monotonic()
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire(priority)
+                await self.global_bucket.acquire(priority)
+                self.wait_seconds += time.monotonic() - started
+            try:
+                return await self._call(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                delay = float(e.retry_after)
+                attempt += 1
+                log.warning("RetryAfter %.1fs on %s (chat %s, attempt %d)", delay, endpoint, chat_id, attempt)
+                if attempt > RATE_MAX_RETRIES:
+                    raise
+                if not limited:
+                    await asyncio.sleep(delay)
+                    continue
+                # مثل AIORateLimiter في PTB: الـ 429 قد يكون حدًا عامًا للبوت، فنوقف كل الإرسال
+                # لا هذه المحادثة وحدها، وإلا تستمر بقية المحادثات في الاصطدام بالحد
+                self.global_bucket.pause(delay)
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(delay)
+
+    @staticmethod
+    async def _call(endpoint: str, callback, args, kwargs):
+        labels = (("endpoint", endpoint),)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            METRICS.inc("telegram_api_errors_total", labels + (("error", type(e).__name__),))
+            raise
+        finally:
+            METRICS.observe("telegram_api_seconds", labels, time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "retry_after": self.retry_after,
+            "wait_seconds": round(self.wait_seconds, 3),
+            "global_waiting": len(self.global_bucket),
+            "chat_buckets": len(self._chats),
+        }
+
+OUTBOUND = OutboundScheduler()
+
+# ===================== مقاييس الحالة =====================
+METRICS.gauge("catalog_items", lambda: {(("section", k),): len(v) for k, v in CATALOG.items()},
+              "Top-level items per catalog section")
+METRICS.gauge("catalog_files", lambda: len(CATALOG.files))
+METRICS.gauge("catalog_missing_files", lambda: len(CATALOG.missing))
+METRICS.gauge("catalog_version", lambda: CATALOG.version)
+METRICS.gauge("asset_index_files", lambda: len(ASSET_INDEX))
+METRICS.gauge("users_cached", lambda: len(USERS))
+METRICS.gauge("users_pending_writes", lambda: USERS.pending())
+METRICS.gauge("membership_cache_entries", lambda: len(MEMBERSHIP))
+METRICS.gauge("keyboard_cache_entries", lambda: len(_KB_CACHE))
+METRICS.gauge("menu_taps_tracked", lambda: len(TAPS))
+METRICS.gauge("file_id_cache_entries", lambda: len(FILE_IDS))
+METRICS.gauge("updates_active", lambda: UPDATES.active)
+METRICS.gauge("updates_queue_depth", lambda: UPDATES.waiting)
+METRICS.gauge("outbound_waiting", lambda: len(OUTBOUND.global_bucket))
+METRICS.gauge("outbound_retry_after", lambda: OUTBOUND.retry_after)
+METRICS.gauge("uploads_active", lambda: UPLOADS.active)
+METRICS.gauge("uploads_queue_depth", lambda: UPLOADS.waiting)
+METRICS.gauge("uploads_inflight_bytes", lambda: UPLOADS.inflight_bytes)
+METRICS.gauge("bundles_built", lambda: BUNDLES.built)
+METRICS.gauge("bundles_evicted", lambda: BUNDLES.evicted)
+METRICS.gauge("asset_meta_entries", lambda: len(ASSET_META))
+METRICS.gauge("asset_meta_indexed", lambda: META.indexed)
+METRICS.gauge("asset_meta_failed", lambda: META.failed)
 
-    app = ApplicationBuilder().token(TOKEN).build()
+# ===================== التشغيل =====================
+# BOT_MODE=webhook يستقبل التحديثات على WEBHOOK_PATH من خادم HTTP نفسه الذي يخدم /healthz.
+# إذا كان WEBHOOK_URL فارغًا لا يُسجَّل الـ webhook عند تيليجرام (مفيد للاختبار المحلي
+# بإرسال تحديثات مسجّلة عبر POST). الافتراضي: webhook إذا ضُبط WEBHOOK_URL وإلا polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/" + os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()
+BOT_MODE = os.getenv("BOT_MODE") or ("webhook" if WEBHOOK_URL else "polling")
+# خادم Bot API بديل (خادم محلي أو الخادم الوهمي في bench/)
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+
+def webhook_handler(app):
+    async def handle(headers: dict, body: bytes):
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return 403, "text/plain", b""
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except Exception:
+            return 400, "text/plain", b""
+        await app.update_queue.put(update)
+        return 200, "text/plain", b""
+    return handle
+
+def worker_handler(app):
+    # مثل webhook_handler لكن لا يرد إلا بعد معالجة التحديث: الموزّع يعيد الإرسال إن مات العامل قبلها
+    async def handle(headers: dict, body: bytes):
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return 403, "text/plain", b""
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except Exception:
+            return 400, "text/plain", b""
+        await app.update_processor.process_update(update, app.process_update(update))
+        return 200, "text/plain", b""
+    return handle
+
+# حلقات الخلفية تُنشأ بـ asyncio.create_task (post_init يعمل قبل app.start)، وتُلغى في on_shutdown
+_BACKGROUND: list[asyncio.Task] = []
+
+async def on_startup(app):
+    await warm_keyboards(list(CATALOG))
+    loops = []
+    if ASSET_INDEX_POLL > 0:
+        loops.append(asset_index_poller())
+    if USERS.backend:
+        loops.append(USERS.flusher())
+    if CATALOG_WATCH_SECONDS > 0:
+        loops.append(catalog_watcher())
+    if UPDATE_STATS_SECONDS > 0:
+        loops.append(update_stats_logger())
+    if META_WORKERS > 0:
+        loops.append(META.run())
+        META.kick()
+    _BACKGROUND.extend(asyncio.create_task(c) for c in loops)
+
+async def on_shutdown(app):
+    for task in _BACKGROUND:
+        task.cancel()
+    await asyncio.gather(*_BACKGROUND, return_exceptions=True)
+    _BACKGROUND.clear()
+    META.close()
+    if USERS.backend:
+        await USERS.flush()
+
+def build_app(token: str = TOKEN):
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .concurrent_updates(UPDATES)
+        .rate_limiter(OUTBOUND)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     # /start الآن شاشة ترحيب فيها زر Start
     app.add_handler(CommandHandler("start", landing))
     app.add_handler(CommandHandler("reload", cmd_reload))
     app.add_handler(CallbackQueryHandler(on_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    app.add_handler(InlineQueryHandler(on_inline_query))
+    return app
+
+async def start_updates(app, http: HttpServer):
+    if BOT_MODE == "worker":
+        http.route("POST", "/update", worker_handler(app))
+        log.info("👷 Worker %s ready on port %s", WORKER_INDEX, PORT)
+        return
+    if BOT_MODE == "webhook":
+        http.route("POST", WEBHOOK_PATH, webhook_handler(app))
+        if not WEBHOOK_URL:
+            log.info("🪝 Webhook on %s (not registered: WEBHOOK_URL is empty)", WEBHOOK_PATH)
+            return
+        try:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            log.info("🪝 Webhook set: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+            return
+        except Exception as e:
+            log.error("setWebhook failed, falling back to polling: %s", e)
+    await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    log.info("📡 Polling started")
+
+async def run_bot(app):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    http = HttpServer()
+    http.route("GET", "/healthz", healthz)
+    http.route("GET", "/metrics", metrics_endpoint)
+    await http.start("127.0.0.1" if BOT_MODE == "worker" else "0.0.0.0")
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await start_updates(app, http)
+        await app.start()
+        log.info("🤖 Telegram bot running (%s)", BOT_MODE)
+        await stop.wait()
+    finally:
+        await http.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# ===================== العمّال المتعددون =====================
+# BOT_WORKERS=N (>1): هذه العملية تصبح موزّعًا يستقبل التحديثات (webhook أو polling) ولا يعالجها،
+# ويمررها إلى N عمليات عاملة محلية (BOT_MODE=worker) حسب حلقة تجزئة ثابتة على معرّف المستخدم،
+# فتبقى حالة كل مستخدم وكاشاته في عامل واحد. كل عامل يحمّل الكتالوج المُجمَّع للقراءة فقط.
+# لكل مستخدم له تحديثات معلّقة "مسار" خاص يرسلها بالترتيب واحدًا واحدًا، فرفع ملف بطيء لا يؤخر
+# إلا صاحبه. لا يُعتبر التحديث مُسلَّمًا حتى يرد العامل بعد معالجته؛ إن مات العامل يعيد المشرف
+# تشغيله ويُعاد إرسال التحديث نفسه.
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("BOT_WORKER_INDEX", "0"))
+WORKER_PORT_BASE = int(os.getenv("WORKER_PORT_BASE", str(PORT + 1)))
+WORKER_CONNECTIONS = int(os.getenv("WORKER_CONNECTIONS", "512"))  # اتصالات متوازية لكل عامل
+WORKER_VNODES = 64
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    def __init__(self, nodes: int, vnodes: int = WORKER_VNODES):
+        points = sorted((_ring_hash(f"worker-{n}:{v}"), n) for n in range(nodes) for v in range(vnodes))
+        self._keys = [h for h, _ in points]
+        self._nodes = [n for _, n in points]
+
+    def node(self, key: int) -> int:
+        i = bisect_left(self._keys, _ring_hash(str(key)))
+        return self._nodes[i % len(self._nodes)]
+
+def update_user_key(data: dict) -> int:
+    # معرّف المستخدم من التحديث الخام دون بناء كائن Update
+    member = data.get("chat_member")
+    if isinstance(member, dict):
+        # "from" هنا هو المشرف الذي نفّذ التغيير؛ كاش الاشتراك المعني عند عامل العضو نفسه
+        who = (member.get("new_chat_member") or {}).get("user")
+        if isinstance(who, dict) and "id" in who:
+            return who["id"]
+    for value in data.values():
+        if isinstance(value, dict):
+            for field in ("from", "user", "chat"):
+                who = value.get(field)
+                if isinstance(who, dict) and "id" in who:
+                    return who["id"]
+    return data.get("update_id", 0)
+
+class WorkerProcess:
+    def __init__(self, index: int, client, on_coalesced=None):
+        self.index = index
+        self.port = WORKER_PORT_BASE + index
+        self.url = f"http://127.0.0.1:{self.port}/update"
+        self.client = client
+        self.on_coalesced = on_coalesced
+        # معرّف المستخدم -> تحديثاته المعلّقة: (الجسم، معرّف نقرة التنقّل أو None)
+        self.lanes: dict[int, deque[tuple[bytes, str | None]]] = {}
+        self._senders: set[asyncio.Task] = set()
+        self.proc: asyncio.subprocess.Process | None = None
+        self.restarts = 0
+        self.delivered = 0
+        self.retries = 0
+
+    def pending(self) -> int:
+        return sum(map(len, self.lanes.values()))
+
+    def put(self, key: int, body: bytes, tap: str | None = None):
+        # العامل لا يرى إلا تحديثًا واحدًا لكل مستخدم، فدمج نقرات التنقّل (TAPS) يحدث هنا:
+        # نقرة تنقّل جديدة تُسقط نقرات التنقّل التي تنتظر خلف التحديث الجاري
+        lane = self.lanes.get(key)
+        if lane is not None:
+            if tap:
+                for i in range(len(lane) - 1, 0, -1):
+                    if lane[i][1]:
+                        self._coalesced(lane[i][1])
+                        del lane[i]
+            lane.append((body, tap))
+            return
+        lane = self.lanes[key] = deque(((body, tap),))
+        task = asyncio.create_task(self.deliver(key, lane))
+        self._senders.add(task)
+        task.add_done_callback(self._senders.discard)
+
+    async def supervise(self, stopping: asyncio.Event):
+        env = {
+            **os.environ,
+            "BOT_MODE": "worker",
+            "BOT_WORKERS": "1",
+            "BOT_WORKER_INDEX": str(self.index),
+            "PORT": str(self.port),
+            # حد تيليجرام الكلي للبوت يُقسَم على العمّال؛ حدود المحادثة تبقى كما هي
+            "RATE_GLOBAL": str(RATE_GLOBAL / BOT_WORKERS),
+            # المهلة تُطبَّق في مسارات الموزّع؛ العامل لا يرى نقرة أحدث ليدمجها
+            "MENU_DEBOUNCE_MS": "0",
+            "UPDATE_STATS_SECONDS": os.getenv("UPDATE_STATS_SECONDS", "0"),
+        }
+        while not stopping.is_set():
+            started = time.monotonic()
+            self.proc = await asyncio.create_subprocess_exec(
+                sys.executable, str(Path(__file__).resolve()), env=env)
+            code = await self.proc.wait()
+            if stopping.is_set():
+                break
+            self.restarts += 1
+            log.warning("Worker %d exited with %s, restarting", self.index, code)
+            if time.monotonic() - started < 5:
+                await asyncio.sleep(min(30, self.restarts))
+
+    async def deliver(self, key: int, lane: deque):
+        # يبقى التحديث في رأس المسار حتى يُسلَّم، ويُحذف المسار حين يفرغ
+        try:
+            while lane:
+                body, tap = lane[0]
+                if tap and MENU_DEBOUNCE:
+                    await asyncio.sleep(MENU_DEBOUNCE)
+                    if any(t for _, t in islice(lane, 1, None)):
+                        # وصلت نقرة تنقّل أحدث أثناء المهلة
+                        lane.popleft()
+                        self._coalesced(tap)
+                        continue
+                await self._post(body)
+                lane.popleft()
+        finally:
+            if self.lanes.get(key) is lane and not lane:
+                del self.lanes[key]
+
+    def _coalesced(self, query_id: str):
+        METRICS.inc("menu_edits_total", (("result", "coalesced"),))
+        if self.on_coalesced:
+            self.on_coalesced(query_id)
+
+    async def _post(self, body: bytes):
+        delay = 0.2
+        while True:
+            try:
+                r = await self.client.post(self.url, content=body, headers={
+                    "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET,
+                    "Content-Type": "application/json",
+                })
+                if r.status_code == 200:
+                    self.delivered += 1
+                    return
+                if r.status_code in (400, 403):
+                    log.warning("Worker %d rejected update (%d), dropped", self.index, r.status_code)
+                    return
+            except httpx.TransportError:
+                pass
+            # العامل متوقف أو يُعاد تشغيله: نحتفظ بالتحديث ونعيد المحاولة
+            self.retries += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+    async def drain(self):
+        while self.lanes:
+            await asyncio.sleep(0.1)
+
+    async def stop(self):
+        for task in list(self._senders):
+            task.cancel()
+        if self.proc and self.proc.returncode is None:
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), 15)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+
+class Dispatcher:
+    def __init__(self, workers: int, client, bot: Bot | None = None):
+        self.ring = HashRing(workers)
+        self.workers = [WorkerProcess(i, client, self.answer_coalesced) for i in range(workers)]
+        self.bot = bot
+        self.received = 0
+        self._answers: set[asyncio.Task] = set()
+
+    @staticmethod
+    def _nav_tap(data: dict) -> str | None:
+        q = data.get("callback_query")
+        if isinstance(q, dict) and str(q.get("data") or "").partition("|")[0] in COALESCE_KINDS:
+            return q.get("id")
+        return None
+
+    def dispatch(self, body: bytes, data: dict):
+        key = update_user_key(data)
+        self.received += 1
+        self.workers[self.ring.node(key)].put(key, body, self._nav_tap(data))
+
+    def answer_coalesced(self, query_id: str):
+        # النقرة المُسقطة لن تصل للعامل: نرد عليها هنا حتى لا يبقى مؤشر التحميل على الزر
+        if self.bot is None:
+            return
+        task = asyncio.create_task(self._answer(query_id))
+        self._answers.add(task)
+        task.add_done_callback(self._answers.discard)
 
+    async def _answer(self, query_id: str):
+        try:
+            await self.bot.answer_callback_query(query_id)
+        except Exception as e:
+            log.debug("answerCallbackQuery for coalesced tap failed: %s", e)
+
+    def webhook(self):
+        async def handle(headers: dict, body: bytes):
+            token = headers.get("x-telegram-bot-api-secret-token", "")
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                return 403, "text/plain", b""
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return 400, "text/plain", b""
+            self.dispatch(body, data)
+            return 200, "text/plain", b""
+        return handle
+
+    async def poll(self, bot: Bot):
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            try:
+                batch = await bot.do_api_request("getUpdates", api_kwargs={
+                    "offset": offset, "timeout": 30, "allowed_updates": Update.ALL_TYPES,
+                }, read_timeout=40)
+            except Exception as e:
+                log.warning("getUpdates failed: %s", e)
+                await asyncio.sleep(2)
+                continue
+            for data in batch:
+                self.dispatch(json.dumps(data).encode(), data)
+                offset = data["update_id"] + 1
+
+    def pending(self) -> int:
+        return sum(w.pending() for w in self.workers)
+
+async def run_dispatcher():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(None, connect=5),
+        limits=httpx.Limits(max_connections=BOT_WORKERS * WORKER_CONNECTIONS,
+                            max_keepalive_connections=BOT_WORKERS * WORKER_CONNECTIONS),
+    )
+    dispatcher = Dispatcher(BOT_WORKERS, client)
+    METRICS.gauge("dispatcher_pending", lambda: {(("worker", str(w.index)),): w.pending()
+                                                  for w in dispatcher.workers})
+    METRICS.gauge("dispatcher_delivered", lambda: {(("worker", str(w.index)),): w.delivered
+                                                    for w in dispatcher.workers})
+    METRICS.gauge("dispatcher_retries", lambda: {(("worker", str(w.index)),): w.retries
+                                                  for w in dispatcher.workers})
+    METRICS.gauge("worker_restarts", lambda: {(("worker", str(w.index)),): w.restarts
+                                               for w in dispatcher.workers})
+    tasks = []
+    for w in dispatcher.workers:
+        tasks.append(asyncio.create_task(w.supervise(stop)))
+
+    http = HttpServer()
+    http.route("GET", "/healthz", healthz)
+    http.route("GET", "/metrics", metrics_endpoint)
+    bot = Bot(TOKEN, base_url=f"{BOT_API_URL}/bot", base_file_url=f"{BOT_API_URL}/file/bot")
+    await bot.initialize()
+    dispatcher.bot = bot
+    if BOT_MODE == "webhook":
+        http.route("POST", WEBHOOK_PATH, dispatcher.webhook())
+        if WEBHOOK_URL:
+            await bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES)
+            log.info("🪝 Webhook set: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+    poller = None if BOT_MODE == "webhook" else asyncio.create_task(dispatcher.poll(bot))
+    await http.start()
+    log.info("🔀 Dispatcher running (%s) with %d workers", BOT_MODE, BOT_WORKERS)
+    try:
+        await stop.wait()
+    finally:
+        await http.stop()
+        if poller:
+            poller.cancel()
+        # نسلّم ما استُلم قبل إيقاف العمّال
+        try:
+            await asyncio.wait_for(asyncio.gather(*(w.drain() for w in dispatcher.workers)), 30)
+        except asyncio.TimeoutError:
+            log.warning("Dispatcher stopped with %d undelivered updates", dispatcher.pending())
+        await asyncio.gather(*(w.stop() for w in dispatcher.workers))
+        for task in tasks:
+            task.cancel()
+        await client.aclose()
+        await bot.shutdown()
+
+def compile_catalog_cli(args: list[str]):
+    try:
+        snap = compile_catalog(allow_missing="--allow-missing" in args)
+    except CatalogError as e:
+        log.error("❌ Catalog build failed: %s", e)
+        raise SystemExit(1)
+    if snap.missing:
+        log.warning("Catalog paths not found on disk (%d): %s", len(snap.missing), ", ".join(snap.missing))
+    log.info("✅ Catalog compiled to %s: %d files, %d series", CATALOG_SNAPSHOT, len(snap.files), len(snap.series))
+
+def main():
+    if sys.argv[1:2] == ["compile-catalog"]:
+        compile_catalog_cli(sys.argv[2:])
+        return
+    if not TOKEN:
+        raise RuntimeError("TELEGRAM_TOKEN is not set")
+    if BOT_WORKERS > 1 and BOT_MODE != "worker":
+        asyncio.run(run_dispatcher())
+        return
+    app = build_app()
     log.info("🤖 Telegram bot starting…")
-    app.run_polling(close_loop=False)
+    asyncio.run(run_bot(app))
 
 if __name__ == "__main__":
     main()
-
-
-
@@ -2,3 +2,11 @@
 set -e
 pip install -U pip
 pip install -r requirements.txt
+
+# يتحقق من الكتالوج ويحل كل مساراته ويكتب assets/catalog.snapshot ليُقلع البوت منه مباشرة.
+# أخطاء البنية تُفشل البناء دائمًا؛ الملفات المفقودة تُفشله فقط مع CATALOG_STRICT=1.
+if [ "${CATALOG_STRICT:-0}" = "1" ]; then
+  python bot.py compile-catalog
+else
+  python bot.py compile-catalog --allow-missing
+fi